@@ -0,0 +1,76 @@
+"""
+Bytes allocated per MQTT publish, unix port.
+
+Run from the repository root:
+
+    MICROPYPATH=src:.frozen micropython bench/publish_alloc.py
+
+Compares the previous per-message bytearray encoder with the current
+MQTTClient._publish, which reuses the preallocated TX buffer.
+"""
+
+import gc
+import struct
+import uasyncio as asyncio
+
+from mqtt_as import MQTTClient, vbi
+
+N = 200
+TOPIC = b"example.com/2a1b3c4d-0000-4000-8000-000000000000/pepeunit"
+PAYLOADS = (b"1", b"x" * 64, b"x" * 512)
+
+
+class _NullSock:
+    def write(self, data):
+        return len(data)
+
+
+async def _legacy_publish(client, topic, msg, retain, qos, dup, pid):
+    t_len = len(topic)
+    m_len = len(msg)
+    sz = 2 + t_len + m_len
+    if qos > 0:
+        sz += 2
+    buf = bytearray(5 + sz)
+    buf[0] = 0x30 | (qos << 1) | retain | (dup << 3)
+    offs = vbi(buf, 1, sz)
+    struct.pack_into("!H", buf, offs, t_len)
+    offs += 2
+    buf[offs:offs + t_len] = topic
+    offs += t_len
+    if qos > 0:
+        struct.pack_into("!H", buf, offs, pid)
+        offs += 2
+    buf[offs:offs + m_len] = msg
+    offs += m_len
+    await client._as_write(buf, offs)
+
+
+async def _measure(publish, client, payload):
+    gc.collect()
+    gc.disable()
+    before = gc.mem_alloc()
+    for _ in range(N):
+        await publish(client, TOPIC, payload, 0, 0, 0, 1)
+    used = gc.mem_alloc() - before
+    gc.enable()
+    return used // N
+
+
+async def _current_publish(client, topic, msg, retain, qos, dup, pid):
+    await client._publish(topic, msg, retain, qos, dup, pid)
+
+
+async def main():
+    client = MQTTClient(client_id=b"bench", server="localhost")
+    client._sock = _NullSock()
+    client._state = client.CONNECTED
+
+    print("payload_len  legacy_B/msg  current_B/msg")
+    for payload in PAYLOADS:
+        legacy = await _measure(_legacy_publish, client, payload)
+        current = await _measure(_current_publish, client, payload)
+        print("{:>11}  {:>12}  {:>13}".format(len(payload), legacy, current))
+
+
+asyncio.run(main())
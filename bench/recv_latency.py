@@ -0,0 +1,84 @@
+"""
+Inbound latency and idle wakeups of the mqtt_as receive loop, unix port.
+
+Needs a local broker (e.g. mosquitto) on localhost:1883. Run from the
+repository root:
+
+    MICROPYPATH=src:.frozen micropython bench/recv_latency.py
+
+Compares the previous 5 ms sleep polling with the current loop, which
+waits on socket readiness. Reports publish -> callback latency and how
+many times the receive loop woke up while the link was idle.
+"""
+
+import time
+import uasyncio as asyncio
+
+from mqtt_as import MQTTClient
+
+HOST = "localhost"
+TOPIC = b"pepeunit/bench/latency"
+N = 100
+IDLE_S = 5
+
+
+class _PollingClient(MQTTClient):
+    async def _wait_readable(self):
+        await asyncio.sleep_ms(5)
+
+
+class _Probe:
+    def __init__(self):
+        self.sent = 0
+        self.latencies = []
+        self.got = asyncio.Event()
+
+    def on_message(self, topic, msg, retained):
+        self.latencies.append(time.ticks_diff(time.ticks_us(), self.sent))
+        self.got.set()
+
+
+def _count_wakeups(client):
+    counter = [0]
+    orig = client._try_read_byte
+
+    def counted():
+        counter[0] += 1
+        return orig()
+
+    client._try_read_byte = counted
+    return counter
+
+
+async def _run(cls, name):
+    probe = _Probe()
+    client = cls(client_id=b"bench-" + name.encode(), server=HOST, subs_cb=probe.on_message, ping_interval=60)
+    wakeups = _count_wakeups(client)
+    await client.connect()
+    await client.subscribe(TOPIC, qos=0)
+
+    for i in range(N):
+        probe.got.clear()
+        probe.sent = time.ticks_us()
+        await client.publish(TOPIC, str(i))
+        await probe.got.wait()
+
+    wakeups[0] = 0
+    await asyncio.sleep(IDLE_S)
+    idle = wakeups[0]
+    await client.disconnect()
+
+    lat = sorted(probe.latencies)
+    print(
+        "{:>8}  avg {:>6} us  p50 {:>6} us  p95 {:>6} us  idle wakeups/s {:>4}".format(
+            name, sum(lat) // len(lat), lat[len(lat) // 2], lat[len(lat) * 95 // 100], idle // IDLE_S
+        )
+    )
+
+
+async def main():
+    await _run(_PollingClient, "polling")
+    await _run(MQTTClient, "poll-io")
+
+
+asyncio.run(main())
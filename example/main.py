@@ -22,7 +22,7 @@ import gc
 import uasyncio as asyncio
 
 from pepeunit_micropython_client.client import PepeunitClient
-from pepeunit_micropython_client.enums import SearchTopicType, SearchScope
+from pepeunit_micropython_client.enums import PayloadDecoder
 from pepeunit_micropython_client.cipher import AesGcmCipher
     
 last_output_send_time = 0
@@ -42,27 +42,13 @@ async def output_handler(client: PepeunitClient):
         last_output_send_time = current_time
 
 
-async def input_handler(client: PepeunitClient, msg):
-    try:
-        topic_parts = msg.topic.split("/")
-        if len(topic_parts) == 3:
-            gc.collect()
-            topic_name = await client.schema.find_topic_by_unit_node(
-                msg.topic, SearchTopicType.FULL_NAME, SearchScope.INPUT
-            )
+async def input_pepeunit_handler(client: PepeunitClient, msg):
+    print('time', time.ticks_ms(), 'free mem:', gc.mem_free())
+    client.logger.debug("Get from input/pepeunit: {}".format(msg.payload), file_only=True)
 
-            if topic_name == "input/pepeunit":
-                value = msg.payload
-                try:
-                    value = int(value)
-                    print('time', time.ticks_ms(), 'free mem:', gc.mem_free())
-                    client.logger.debug("Get from input/pepeunit: {}".format(value), file_only=True)
 
-                except ValueError:
-                    client.logger.error("Value is not a number: {}".format(value))
-
-    except Exception as e:
-        client.logger.error("Input handler error: {}".format(e))
+async def input_handler(client: PepeunitClient, msg):
+    client.logger.debug("Unrouted MQTT message: {}".format(msg.topic), file_only=True)
 
 
 async def test_set_get_storage(client: PepeunitClient):
@@ -94,17 +80,12 @@ async def test_get_units(client: PepeunitClient):
             
             if unit_node_uuids:
                 gc.collect()
-                units_response = await client.rest_client.get_units_by_nodes(
-                    unit_node_uuids,
-                    limit=1,
-                    offset=0
-                )
-                client.logger.info("Found {} units".format(units_response.get('count', 0)))
-                
-                for unit in units_response.get('units', []):
+                units = client.rest_client.iter_units_by_nodes(unit_node_uuids, page_size=5)
+                async for unit in units:
                     name = unit.get('name')
                     uuid = unit.get('uuid')
                     client.logger.info("Unit: {} (UUID: {})".format(name, uuid))
+                client.logger.info("Found {} units".format(units.count or 0))
             gc.collect()
 
     except Exception as e:
@@ -128,6 +109,7 @@ async def main_async(client: PepeunitClient):
     await test_cipher(client)
     
     client.set_mqtt_input_handler(input_handler)
+    client.on_input("input/pepeunit", input_pepeunit_handler, decoder=PayloadDecoder.INT)
     client.subscribe_all_schema_topics()
     client.set_output_handler(output_handler)
     await client.run_main_cycle()
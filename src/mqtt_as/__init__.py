@@ -16,6 +16,18 @@ from sys import platform
 
 BUSY_ERRORS = [EINPROGRESS, ETIMEDOUT, 118, 119] if platform == "esp32" else [EINPROGRESS, ETIMEDOUT]
 
+# Preallocated TX buffer: publishes that fit are encoded in place and sent
+# with one write, larger ones stream topic and payload without copying.
+OBUF_SIZE = 256
+# Receive buffer: one readinto pulls in as many bytes as the socket has,
+# packets are then parsed out of it without a syscall per field.
+RBUF_SIZE = 256
+# _ibuf grows for a large message and is shrunk back to this size afterwards;
+# messages above max_payload are streamed to chunk_cb in chunks of this size.
+IBUF_KEEP = 256
+# The link is considered dead after this many ping intervals without rx.
+STALE_INTERVALS = 2
+
 
 async def eliza(*_):
     await utils.ayield()
@@ -28,6 +40,15 @@ def pid_gen():
         yield pid
 
 
+class PubTopic:
+    __slots__ = ("name", "wire")
+
+    def __init__(self, name):
+        self.name = name
+        topic = utils.to_bytes(name)
+        self.wire = struct.pack("!H", len(topic)) + topic
+
+
 @micropython.viper
 def vbi(buf, offs: int, x: int) -> int:
     pb = ptr8(buf)
@@ -54,20 +75,34 @@ class MQTTClient:
         "_client_id",
         "_connect_handler",
         "_has_connected",
+        "_chunk_cb",
         "_ibuf",
+        "_ibuf_keep",
         "_keepalive",
+        "_inflight",
+        "_max_inflight",
+        "_max_payload",
         "_max_repubs",
         "_mvbuf",
+        "_obuf",
         "_ping_interval",
         "_pswd",
+        "_rbuf",
+        "_rbuf_end",
+        "_rbuf_start",
         "_response_time",
+        "_rmv",
+        "_should_drop",
         "_state",
         "_sock",
         "_ssl",
         "_ssl_params",
         "_tasks",
         "_user",
+        "_zero_copy",
+        "_window",
         "last_rx",
+        "last_tx",
         "lock",
         "newpid",
         "port",
@@ -91,8 +126,13 @@ class MQTTClient:
         clean_init=True,
         clean=True,
         max_repubs=4,
+        max_inflight=4,
         subs_cb=None,
         should_drop=None,
+        zero_copy=False,
+        max_payload=0,
+        chunk_cb=None,
+        ibuf_keep=IBUF_KEEP,
         connect_coro=eliza,
     ):
         self._client_id = client_id
@@ -101,6 +141,7 @@ class MQTTClient:
         self._keepalive = keepalive
         self._response_time = response_time * 1000
         self._max_repubs = max_repubs
+        self._max_inflight = max_inflight if max_inflight > 0 else 1
         self._clean_init = clean_init
         self._clean = clean
         self._ping_interval = ping_interval * 1000
@@ -117,6 +158,10 @@ class MQTTClient:
         self._ssl_params = ssl_params or {}
         self._cb = subs_cb or (lambda *_: None)
         self._should_drop = should_drop
+        self._zero_copy = zero_copy
+        self._max_payload = max_payload
+        self._chunk_cb = chunk_cb
+        self._ibuf_keep = ibuf_keep
         self._connect_handler = connect_coro
 
         self.port = port or (8883 if ssl else 1883)
@@ -124,15 +169,41 @@ class MQTTClient:
         self._sock = None
 
         self.newpid = pid_gen()
-        self.rcv_pids = set()
+        self.rcv_pids = {}
+        self._inflight = 0
+        self._window = asyncio.Event()
         self.last_rx = time.ticks_ms()
+        self.last_tx = self.last_rx
         self.lock = asyncio.Lock()
         self._ibuf = bytearray(50)
         self._mvbuf = memoryview(self._ibuf)
+        self._obuf = bytearray(OBUF_SIZE)
+        self._rbuf = bytearray(RBUF_SIZE)
+        self._rmv = memoryview(self._rbuf)
+        self._rbuf_start = 0
+        self._rbuf_end = 0
 
     def _timeout(self, t):
         return time.ticks_diff(time.ticks_ms(), t) > self._response_time
 
+    def _rx_fill(self, sock=None):
+        if sock is None:
+            sock = self._sock
+        self._rbuf_start = 0
+        self._rbuf_end = 0
+        try:
+            n = sock.readinto(self._rmv)
+        except OSError as e:
+            if e.args[0] in BUSY_ERRORS:
+                return None
+            raise
+        if n == 0:
+            raise OSError(-1, "Connection closed by host")
+        if n is not None:
+            self._rbuf_end = n
+            self.last_rx = time.ticks_ms()
+        return n
+
     async def _as_read(self, n, sock=None, use_ibuf=True):
         if sock is None:
             sock = self._sock
@@ -148,24 +219,44 @@ class MQTTClient:
         size = 0
         t = time.ticks_ms()
         while size < n:
+            avail = self._rbuf_end - self._rbuf_start
+            if avail:
+                take = avail if avail < n - size else n - size
+                start = self._rbuf_start
+                buffer[size:size + take] = self._rmv[start:start + take]
+                self._rbuf_start = start + take
+                size += take
+                t = time.ticks_ms()
+                continue
             if self._timeout(t) or self._state == self.DISCONNECTED:
                 raise OSError(-1, "Timeout on socket read")
-            try:
-                msg_size = sock.readinto(buffer[size:], n - size)
-            except OSError as e:
-                msg_size = None
-                if e.args[0] not in BUSY_ERRORS:
-                    raise
-            if msg_size == 0:
-                raise OSError(-1, "Connection closed by host")
-            if msg_size is not None:
-                size += msg_size
-                t = time.ticks_ms()
-                self.last_rx = t
-            else:
-                await utils.ayield(do_gc=False)
+            if n - size >= len(self._rbuf):
+                # Large payloads go straight into the destination buffer.
+                try:
+                    msg_size = sock.readinto(buffer[size:], n - size)
+                except OSError as e:
+                    msg_size = None
+                    if e.args[0] not in BUSY_ERRORS:
+                        raise
+                if msg_size == 0:
+                    raise OSError(-1, "Connection closed by host")
+                if msg_size is not None:
+                    size += msg_size
+                    t = time.ticks_ms()
+                    self.last_rx = t
+                    continue
+            elif self._rx_fill(sock) is not None:
+                continue
+            await utils.ayield(do_gc=False)
         return buffer[:n]
 
+    async def _read_byte(self):
+        start = self._rbuf_start
+        if start < self._rbuf_end:
+            self._rbuf_start = start + 1
+            return self._rbuf[start]
+        return (await self._as_read(1))[0]
+
     async def _as_write(self, bytes_wr, length=0, sock=None):
         if sock is None:
             sock = self._sock
@@ -185,6 +276,7 @@ class MQTTClient:
                     raise
             if n:
                 t = time.ticks_ms()
+                self.last_tx = t
                 bytes_wr = bytes_wr[n:]
             else:
                 await utils.ayield(do_gc=False)
@@ -197,13 +289,15 @@ class MQTTClient:
         d = 0
         i = 0
         while True:
-            s = (await self._as_read(1))[0]
+            s = await self._read_byte()
             d |= (s & 0x7F) << (i * 7)
             i += 1
             if not (s & 0x80):
                 return d, i
 
     async def _connect(self, clean):
+        self._rbuf_start = 0
+        self._rbuf_end = 0
         self._sock = socket.socket()
         self._sock.setblocking(False)
         try:
@@ -242,8 +336,8 @@ class MQTTClient:
             await self._send_str(self._pswd)
 
         del premsg, msg
-        packet_type = await self._as_read(1)
-        if packet_type[0] != 0x20:
+        packet_type = await self._read_byte()
+        if packet_type != 0x20:
             raise OSError(-1, "CONNACK not received")
 
         sz, _ = await self._recv_len()
@@ -273,69 +367,107 @@ class MQTTClient:
             self._close()
         self._state = self.DISCONNECTED
         self._has_connected = False
+        self._wake_pids()
 
     def _close(self):
         if self._sock is not None:
             self._sock.close()
 
+    def _add_pid(self, pid):
+        self.rcv_pids[pid] = asyncio.Event()
+
+    def _wake_pids(self):
+        for ev in self.rcv_pids.values():
+            ev.set()
+
     async def _await_pid(self, pid):
-        t = time.ticks_ms()
-        while pid in self.rcv_pids:
-            if self._timeout(t) or self._state == self.DISCONNECTED:
-                break
-            await asyncio.sleep_ms(100)
-        else:
+        ev = self.rcv_pids.get(pid)
+        if ev is None:
             return True
-        return False
+        try:
+            await asyncio.wait_for_ms(ev.wait(), self._response_time)
+        except asyncio.TimeoutError:
+            pass
+        return pid not in self.rcv_pids
+
+    async def wait_window(self):
+        while self._inflight >= self._max_inflight:
+            self._window.clear()
+            await self._window.wait()
 
     async def _publish_core(self, topic, msg, retain, qos, properties=None):
         pid = next(self.newpid)
-        if qos:
-            self.rcv_pids.add(pid)
-        async with self.lock:
-            await self._publish(topic, msg, retain, qos, 0, pid, properties)
         if qos == 0:
+            async with self.lock:
+                await self._publish(topic, msg, retain, qos, 0, pid, properties)
             return
 
-        count = 0
-        while 1:
-            if await self._await_pid(pid):
-                return
-            if count >= self._max_repubs or self._state != self.CONNECTED:
-                raise OSError(-1)
+        await self.wait_window()
+        self._inflight += 1
+        self._add_pid(pid)
+        try:
             async with self.lock:
-                await self._publish(topic, msg, retain, qos, dup=1, pid=pid, properties=properties)
-            count += 1
+                await self._publish(topic, msg, retain, qos, 0, pid, properties)
+            count = 0
+            while 1:
+                if await self._await_pid(pid):
+                    return
+                if count >= self._max_repubs or self._state != self.CONNECTED:
+                    raise OSError(-1)
+                async with self.lock:
+                    await self._publish(topic, msg, retain, qos, dup=1, pid=pid, properties=properties)
+                count += 1
+        finally:
+            self.rcv_pids.pop(pid, None)
+            self._inflight -= 1
+            self._window.set()
 
     async def _publish(self, topic, msg, retain, qos, dup, pid, properties=None):
-        t_len = len(topic)
+        wire = topic.wire if isinstance(topic, PubTopic) else None
+        t_len = len(wire) - 2 if wire is not None else len(topic)
         m_len = len(msg)
         sz = 2 + t_len + m_len
         if qos > 0:
             sz += 2
 
-        # header byte (1) + VBI (max 4) + topic_len (2) + topic + pid (0|2) + msg
-        buf = bytearray(5 + sz)
+        # Called under self.lock, so the shared TX buffer is not contended.
+        buf = self._obuf
         buf[0] = 0x30 | (qos << 1) | retain | (dup << 3)
         offs = vbi(buf, 1, sz)
-        struct.pack_into("!H", buf, offs, t_len)
-        offs += 2
-        buf[offs:offs + t_len] = topic
-        offs += t_len
-        if qos > 0:
-            struct.pack_into("!H", buf, offs, pid)
-            offs += 2
-        buf[offs:offs + m_len] = msg
-        offs += m_len
 
-        await self._as_write(buf, offs)
+        if offs + sz <= len(buf):
+            if wire is not None:
+                buf[offs:offs + t_len + 2] = wire
+            else:
+                struct.pack_into("!H", buf, offs, t_len)
+                buf[offs + 2:offs + 2 + t_len] = topic
+            offs += t_len + 2
+            if qos > 0:
+                struct.pack_into("!H", buf, offs, pid)
+                offs += 2
+            buf[offs:offs + m_len] = msg
+            offs += m_len
+            await self._as_write(buf, offs)
+            return
+
+        if wire is not None:
+            await self._as_write(buf, offs)
+            await self._as_write(wire)
+        else:
+            struct.pack_into("!H", buf, offs, t_len)
+            await self._as_write(buf, offs + 2)
+            await self._as_write(topic)
+        if qos > 0:
+            struct.pack_into("!H", buf, 0, pid)
+            await self._as_write(buf, 2)
+        await self._as_write(msg)
 
     async def _usub(self, topic, qos, _properties):
         sub = qos is not None
         pkt = bytearray(7)
         pkt[0] = 0x82 if sub else 0xA2
         pid = next(self.newpid)
-        self.rcv_pids.add(pid)
+        self._add_pid(pid)
 
         sz = 2 + 2 + len(topic) + (1 if sub else 0)
         offs = vbi(pkt, 1, sz)
@@ -348,18 +480,123 @@ class MQTTClient:
                 await self._as_write(qos.to_bytes(1, "little"))
 
         if not await self._await_pid(pid):
+            self.rcv_pids.pop(pid, None)
             raise OSError(-1)
 
+    async def _sub_batch(self, topics, qos, sz):
+        pid = next(self.newpid)
+        self._add_pid(pid)
+
+        # The shared TX buffer is only touched under self.lock, as in _publish.
+        async with self.lock:
+            buf = self._obuf
+            buf[0] = 0x82
+            offs = vbi(buf, 1, sz)
+            struct.pack_into("!H", buf, offs, pid)
+            offs += 2
+            if offs + sz - 2 <= len(buf):
+                for topic in topics:
+                    t_len = len(topic)
+                    struct.pack_into("!H", buf, offs, t_len)
+                    buf[offs + 2:offs + 2 + t_len] = topic
+                    offs += 2 + t_len
+                    buf[offs] = qos
+                    offs += 1
+                await self._as_write(buf, offs)
+            else:
+                await self._as_write(buf, offs)
+                for topic in topics:
+                    await self._send_str(topic)
+                    await self._as_write(qos.to_bytes(1, "little"))
+        return pid
+
+    async def _usub_many(self, topics, qos, max_packet):
+        pids = []
+        batch = []
+        # remaining length: packet id (2) + per topic: length (2) + topic + qos (1)
+        sz = 2
+        for topic in topics:
+            t_sz = 3 + len(topic)
+            if batch and sz + t_sz + 5 > max_packet:
+                pids.append(await self._sub_batch(batch, qos, sz))
+                batch = []
+                sz = 2
+            batch.append(topic)
+            sz += t_sz
+        if batch:
+            pids.append(await self._sub_batch(batch, qos, sz))
+        del batch
+
+        for pid in pids:
+            if not await self._await_pid(pid):
+                self.rcv_pids.pop(pid, None)
+                raise OSError(-1)
+        return len(pids)
+
     def _try_read_byte(self):
-        try:
-            res = self._sock.read(1)
-            if res:
-                self.last_rx = time.ticks_ms()
-            return res
-        except OSError as e:
-            if e.args[0] in BUSY_ERRORS:
-                return None
-            raise
+        if self._rbuf_start >= self._rbuf_end and self._rx_fill() is None:
+            return None
+        start = self._rbuf_start
+        self._rbuf_start = start + 1
+        return self._rbuf[start]
+
+    async def _read_publish(self, sz):
+        if sz > len(self._ibuf) or gc.mem_free() < sz + 512:
+            gc.collect()
+        # Variable header and payload land in _ibuf together, so topic and
+        # payload can be handed out as views without overwriting each other.
+        return await self._as_read(sz, use_ibuf=True)
+
+    def _deliver_publish(self, op, pkt):
+        topic_len = (pkt[0] << 8) | pkt[1]
+        offs = 2 + topic_len
+        topic = pkt[2:offs]
+
+        pid = None
+        if op & 6:
+            pid = pkt[offs] << 8 | pkt[offs + 1]
+            offs += 2
+
+        if not self._should_drop or not self._should_drop():
+            msg = pkt[offs:]
+            if not self._zero_copy:
+                topic = bytes(topic)
+                msg = bytes(msg)
+            self._cb(topic, msg, bool(op & 0x01))
+        return pid
+
+    async def _stream_publish(self, op, sz):
+        hdr = await self._as_read(2)
+        topic_len = (hdr[0] << 8) | hdr[1]
+        topic = bytes(await self._as_read(topic_len))
+        sz -= 2 + topic_len
+
+        pid = None
+        if op & 6:
+            hdr = await self._as_read(2)
+            pid = hdr[0] << 8 | hdr[1]
+            sz -= 2
+
+        deliver = self._chunk_cb and (not self._should_drop or not self._should_drop())
+        retained = bool(op & 0x01)
+        if deliver and not sz:
+            self._chunk_cb(topic, b"", 0, 0, retained)
+        offs = 0
+        while offs < sz:
+            n = sz - offs
+            if n > self._ibuf_keep:
+                n = self._ibuf_keep
+            chunk = await self._as_read(n)
+            if deliver:
+                self._chunk_cb(topic, chunk, offs, sz, retained)
+            offs += n
+        return pid
+
+    def _shrink_ibuf(self):
+        if len(self._ibuf) > self._ibuf_keep:
+            self._mvbuf = None
+            self._ibuf = bytearray(self._ibuf_keep)
+            self._mvbuf = memoryview(self._ibuf)
 
     async def _process_msg(self, op):
         if op == 0xD0:
@@ -372,7 +609,7 @@ class MQTTClient:
                 raise OSError(-1, "Invalid PUBACK packet")
             rcv_pid = await self._as_read(2)
             pid = rcv_pid[0] << 8 | rcv_pid[1]
-            self._kill_pid(pid, "PUBACK")
+            self._kill_pid(pid)
 
         if op == 0x90 or op == 0xB0:
             sz, _ = await self._recv_len()
@@ -380,40 +617,23 @@ class MQTTClient:
             pid = rcv_pid[0] << 8 | rcv_pid[1]
             sz -= 2
 
-            if sz > 1:
+            if op == 0xB0 and sz > 1:
                 raise OSError(-1, "Got too many bytes")
             if op == 0x90 and sz:
-                rc = (await self._as_read(sz))[0]
-                if rc >= 0x80:
-                    raise OSError(-1, "SUBACK reason 0x{:x}".format(rc))
-            self._kill_pid(pid, "UNSUBACK" if op == 0xB0 else "SUBACK")
+                for rc in await self._as_read(sz):
+                    if rc >= 0x80:
+                        raise OSError(-1, "SUBACK reason 0x{:x}".format(rc))
+            self._kill_pid(pid)
 
         if op & 0xF0 != 0x30:
             return
 
         sz, _ = await self._recv_len()
-        topic_len = await self._as_read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = await self._as_read(topic_len, use_ibuf=True)
-        deliver = not self._should_drop or not self._should_drop()
-        if deliver:
-            topic = bytes(topic)
-        sz -= topic_len + 2
-
-        pid = None
-        if op & 6:
-            pid_data = await self._as_read(2)
-            pid = pid_data[0] << 8 | pid_data[1]
-            sz -= 2
-
-        if sz > len(self._ibuf) or gc.mem_free() < sz + 512:
-            gc.collect()
-        msg = await self._as_read(sz, use_ibuf=True)
-
-        if deliver:
-            msg = bytes(msg)
-            retained = op & 0x01
-            self._cb(topic, msg, bool(retained))
+        if self._max_payload and sz > self._max_payload:
+            pid = await self._stream_publish(op, sz)
+        else:
+            pid = self._deliver_publish(op, await self._read_publish(sz))
+        self._shrink_ibuf()
 
         if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
@@ -423,8 +643,7 @@ class MQTTClient:
             raise OSError(-1, "QoS 2 not supported")
 
     async def connect(self):
-        if not self._has_connected:
-            self._addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self._addr = await utils.resolve(self.server, self.port)
 
         self._state = self.CONNECTING
         try:
@@ -441,6 +660,7 @@ class MQTTClient:
         except Exception:
             self._close()
             self._state = self.DISCONNECTED
+            utils.forget_address(self.server, self.port)
             raise
         self.rcv_pids.clear()
 
@@ -451,32 +671,43 @@ class MQTTClient:
         self._tasks.append(asyncio.create_task(self._keep_alive()))
         asyncio.create_task(self._connect_handler(self))
 
+    async def _wait_readable(self):
+        # Park the task in the asyncio poller until the socket has data.
+        yield asyncio.core._io_queue.queue_read(self._sock)
+
     async def _handle_msg(self):
         try:
             while self._state == self.CONNECTED:
                 res = self._try_read_byte()
                 if res is None:
-                    await asyncio.sleep_ms(5)
+                    await self._wait_readable()
                     continue
-                if res == b"":
-                    raise OSError(-1, "Empty response")
                 async with self.lock:
-                    await self._process_msg(res[0])
+                    await self._process_msg(res)
                 await asyncio.sleep_ms(0)
         except OSError:
             pass
         self._reconnect()
 
     async def _keep_alive(self):
+        # PINGREQ once either direction has been idle for ping_interval: tx
+        # keeps the broker keepalive satisfied, and a PINGRESP refreshes rx
+        # well before STALE_INTERVALS of silence mark the link as dead.
+        interval = self._ping_interval
         while self._state == self.CONNECTED:
-            pings_due = time.ticks_diff(time.ticks_ms(), self.last_rx) // self._ping_interval
-            if pings_due >= 4:
+            now = time.ticks_ms()
+            since_rx = time.ticks_diff(now, self.last_rx)
+            if since_rx >= STALE_INTERVALS * interval:
                 break
-            await asyncio.sleep_ms(self._ping_interval)
+            wait = interval - max(since_rx, time.ticks_diff(now, self.last_tx))
+            if wait > 0:
+                await asyncio.sleep_ms(wait)
+                continue
             try:
                 await self._ping()
             except OSError:
                 break
+            await asyncio.sleep_ms(interval)
         self._reconnect()
 
     async def _kill_tasks(self, kill_skt):
@@ -497,13 +728,14 @@ class MQTTClient:
     def _reconnect(self):
         if self._state != self.DISCONNECTED:
             self._state = self.DISCONNECTED
+            self._wake_pids()
             asyncio.create_task(self._kill_tasks(True))
 
-    def _kill_pid(self, pid, msg):
-        if pid in self.rcv_pids:
-            self.rcv_pids.discard(pid)
-        else:
-            raise OSError(-1, "Invalid pid in {} packet".format(msg))
+    def _kill_pid(self, pid):
+        ev = self.rcv_pids.pop(pid, None)
+        # Unknown pid: a late ACK for a request that already timed out.
+        if ev is not None:
+            ev.set()
 
     async def subscribe(self, topic, qos=0, properties=None):
         if qos not in (0, 1):
@@ -512,6 +744,13 @@ class MQTTClient:
             raise OSError(-1, "Not connected")
         await self._usub(topic, qos, properties)
 
+    async def subscribe_many(self, topics, qos=0, max_packet=OBUF_SIZE):
+        if qos not in (0, 1):
+            raise ValueError("Only qos 0 and 1 are supported.")
+        if self._state != self.CONNECTED:
+            raise OSError(-1, "Not connected")
+        return await self._usub_many(topics, qos, max_packet)
+
     async def unsubscribe(self, topic, properties=None):
         if self._state != self.CONNECTED:
             raise OSError(-1, "Not connected")
@@ -1,2 +1,2 @@
 from .client import PepeunitClient
-from .enums import LogLevel, BaseInputTopicType, BaseOutputTopicType, RestartMode
+from .enums import LogLevel, BaseInputTopicType, BaseOutputTopicType, RestartMode, QueuePolicy, PayloadDecoder
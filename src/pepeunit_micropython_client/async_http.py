@@ -2,6 +2,7 @@ import uasyncio as asyncio
 import utils
 
 import socket
+import time
 import gc
 try:
     import ssl
@@ -10,6 +11,12 @@ except ImportError:
 
 import sys
 
+try:
+    import io
+    import deflate
+except ImportError:
+    deflate = None
+
 from errno import EINPROGRESS, ETIMEDOUT
 
 if sys.platform == "esp32":
@@ -167,34 +174,65 @@ def _parse_status(status_line: bytes) -> int:
     return int(status_line[sp1 + 1 : sp2])
 
 
-async def request(
-    method,
-    url,
-    headers=None,
-    body=None,
-    *,
-    save_to=None,
-    bufsize=256,
-    max_body=64_000,
-    collect_headers=True,
-    header_limit=2048,
-):
-    headers = headers or {}
-    scheme, host, port, path = _parse_url(url)
-    use_ssl = scheme == "https"
+POOL_IDLE_MS = 15000
+POOL_MAX_PER_HOST = 1
+POOL_MAX = 2
 
-    for attempt in range(4):
-        try:
-            await asyncio.sleep_ms(0)
-            addr = socket.getaddrinfo(host, port)[0][-1]
-            break
-        except OSError as e:
-            if e.args and e.args[0] == -2 and attempt < 3:
-                gc.collect()
-                await asyncio.sleep_ms(200 * (attempt + 1))
-                continue
-            raise
+_IDEMPOTENT = (b"GET", b"HEAD", b"PUT", b"DELETE", b"OPTIONS")
+
+# (use_ssl, host, port) -> [(sock, released_ms), ...]
+_pool = {}
+
+
+def _pool_size():
+    return sum(len(v) for v in _pool.values())
 
+
+def _close_quiet(s):
+    try:
+        s.close()
+    except OSError:
+        pass
+
+
+def _is_alive(s) -> bool:
+    # An idle keep-alive socket must have nothing to read: EOF means the
+    # server closed it, stray bytes mean the stream is out of sync.
+    try:
+        n = s.readinto(bytearray(1))
+    except OSError as e:
+        return _is_busy_error(e)
+    return n is None
+
+
+def _pool_acquire(key):
+    conns = _pool.get(key)
+    now = time.ticks_ms()
+    while conns:
+        s, released = conns.pop()
+        if time.ticks_diff(now, released) < POOL_IDLE_MS and _is_alive(s):
+            return s
+        _close_quiet(s)
+    return None
+
+
+def _pool_release(key, s):
+    conns = _pool.setdefault(key, [])
+    if len(conns) >= POOL_MAX_PER_HOST or _pool_size() >= POOL_MAX:
+        _close_quiet(s)
+        return
+    conns.append((s, time.ticks_ms()))
+
+
+def close_idle():
+    for conns in _pool.values():
+        for s, _ in conns:
+            _close_quiet(s)
+    _pool.clear()
+
+
+async def _open(host, port, use_ssl):
+    addr = await utils.resolve(host, port)
     s = socket.socket()
     s.setblocking(False)
     try:
@@ -207,105 +245,443 @@ async def request(
         if use_ssl:
             s = ssl.wrap_socket(s, server_hostname=host)
             await utils.ayield(do_gc=False)
+    except OSError:
+        _close_quiet(s)
+        utils.forget_address(host, port)
+        raise
+    return s
+
+
+class _ReqWriter:
+    # Request line, headers and a small body are assembled here and sent
+    # with one write; anything that does not fit is flushed in order.
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.n = 0
+        self.lock = asyncio.Lock()
 
-        b = utils.to_bytes(body) if body is not None else b""
-
-        await _as_write(s, utils.to_bytes(method))
-        await _as_write(s, b" ")
-        await _as_write(s, utils.to_bytes(path))
-        await _as_write(s, b" HTTP/1.1\r\nHost: ")
-        await _as_write(s, utils.to_bytes(host))
-        await _as_write(s, b"\r\nConnection: close\r\n")
-
-        for k, v in headers.items():
-            await _as_write(s, utils.to_bytes(k))
-            await _as_write(s, b": ")
-            await _as_write(s, utils.to_bytes(v))
-            await _as_write(s, b"\r\n")
-
-        if b:
-            await _as_write(s, b"Content-Length: ")
-            await _as_write(s, str(len(b)).encode("ascii"))
-            await _as_write(s, b"\r\n")
+    async def put(self, s, data):
+        ln = len(data)
+        if self.n + ln > len(self.buf):
+            await self.flush(s)
+            if ln > len(self.buf):
+                await _as_write(s, data)
+                return
+        self.buf[self.n : self.n + ln] = data
+        self.n += ln
 
-        await _as_write(s, b"\r\n")
-        if b:
-            await _as_write(s, b)
+    async def flush(self, s):
+        if self.n:
+            n = self.n
+            self.n = 0
+            await _as_write(s, self.mv[:n])
 
-        reader = _BufferedSock(s, bufsize=bufsize)
 
-        status_line = await reader.readline(limit=256)
-        status = _parse_status(status_line)
+REQ_BUF_SIZE = 512
+_req_writer = _ReqWriter(REQ_BUF_SIZE)
 
-        content_length = -1
 
+async def _send_request(s, method, host, path, headers, b, keep_alive):
+    w = _req_writer
+    async with w.lock:
+        try:
+            await w.put(s, method)
+            await w.put(s, b" ")
+            await w.put(s, utils.to_bytes(path))
+            await w.put(s, b" HTTP/1.1\r\nHost: ")
+            await w.put(s, utils.to_bytes(host))
+            await w.put(s, b"\r\nConnection: keep-alive\r\n" if keep_alive else b"\r\nConnection: close\r\n")
+
+            for k, v in headers.items():
+                await w.put(s, utils.to_bytes(k))
+                await w.put(s, b": ")
+                await w.put(s, utils.to_bytes(v))
+                await w.put(s, b"\r\n")
+
+            if b:
+                await w.put(s, b"Content-Length: ")
+                await w.put(s, str(len(b)).encode("ascii"))
+                await w.put(s, b"\r\n")
+
+            await w.put(s, b"\r\n")
+            if b:
+                await w.put(s, b)
+            await w.flush(s)
+        finally:
+            w.n = 0
+
+
+async def _read_headers(reader, collect_headers, header_limit):
+    resp_headers = {}
+    content_length = -1
+    conn_close = False
+    chunked = False
+    gzip = False
+    while True:
+        line = await reader.readline(limit=header_limit)
+        if not line or line in (b"\r\n", b"\n"):
+            break
+        i = line.find(b":")
+        if i < 0:
+            continue
+        name = line[:i].strip().lower()
         if collect_headers:
-            resp_headers = {}
+            resp_headers[name] = line[i + 1 :].strip()
+        if name == b"content-length":
+            try:
+                content_length = int(line[i + 1 :].strip())
+            except (ValueError, TypeError):
+                pass
+        elif name == b"connection":
+            conn_close = line[i + 1 :].strip().lower() == b"close"
+        elif name == b"transfer-encoding":
+            chunked = b"chunked" in line[i + 1 :].lower()
+        elif name == b"content-encoding":
+            gzip = b"gzip" in line[i + 1 :].lower()
+    return resp_headers, content_length, conn_close, chunked, gzip
+
+
+class _BodyReader:
+    # Yields body bytes as views into the _BufferedSock buffer, framing by
+    # Content-Length, chunked transfer-encoding, or connection close.
+    def __init__(self, reader, content_length=-1, chunked=False):
+        self.reader = reader
+        self.chunked = chunked
+        self.remaining = -1 if chunked else content_length
+        # No framing: the end of the body is only known by the server closing.
+        self.until_close = self.remaining < 0 and not chunked
+        self.done = self.remaining == 0
+        self._chunk_left = 0
+
+    async def _next_chunk_size(self):
+        line = await self.reader.readline(limit=128)
+        if line in (b"\r\n", b"\n"):
+            line = await self.reader.readline(limit=128)
+        i = line.find(b";")
+        size_s = (line[:i] if i >= 0 else line).strip()
+        if not size_s:
+            return -1
+        size = int(size_s.decode(), 16)
+        if size == 0:
             while True:
-                line = await reader.readline(limit=header_limit)
+                line = await self.reader.readline(limit=256)
                 if not line or line in (b"\r\n", b"\n"):
                     break
-                i = line.find(b":")
-                if i < 0:
-                    continue
-                resp_headers[line[:i].strip().lower()] = line[i + 1 :].strip()
-            cl_val = resp_headers.get(b"content-length")
-            if cl_val is not None:
-                try:
-                    content_length = int(cl_val)
-                except (ValueError, TypeError):
-                    pass
-        elif save_to:
-            resp_headers = {}
-            await reader.skip_headers()
-        else:
-            resp_headers = {}
+        return size
+
+    async def readchunk(self, max_n):
+        if self.done:
+            return b""
+        if self.chunked:
+            if self._chunk_left == 0:
+                size = await self._next_chunk_size()
+                if size <= 0:
+                    self.done = size == 0
+                    return b""
+                self._chunk_left = size
+            chunk = await self.reader.readchunk(min(max_n, self._chunk_left))
+            self._chunk_left -= len(chunk)
+            return chunk
+        if self.remaining < 0:
+            return await self.reader.readchunk(max_n)
+        chunk = await self.reader.readchunk(min(max_n, self.remaining))
+        self.remaining -= len(chunk)
+        if self.remaining == 0:
+            self.done = True
+        return chunk
+
+
+# Window for gzip bodies; DeflateIO allocates it per response. A body that
+# back-references further than 2**GZIP_WBITS bytes raises InflateError.
+GZIP_WBITS = 10
+_INFLATE_STEP = 128
+_INFLATE_LOOKAHEAD = 768
+
+
+class InflateError(ValueError):
+    pass
+
+
+if deflate:
+    class _InflateFeed(io.IOBase):
+        # DeflateIO pulls compressed bytes synchronously; _InflateReader keeps
+        # enough staged here that one output step never runs it dry.
+        def __init__(self, size):
+            self.buf = bytearray(size)
+            self.mv = memoryview(self.buf)
+            self.start = 0
+            self.end = 0
+            self.eof = False
+            self.underrun = False
+
+        def readinto(self, buf):
+            n = min(len(buf), self.end - self.start)
+            if n == 0 and not self.eof:
+                self.underrun = True
+            buf[:n] = self.mv[self.start : self.start + n]
+            self.start += n
+            return n
+
+
+class _InflateReader:
+    # Same interface as _BodyReader, yielding inflated bytes of a gzip body.
+    def __init__(self, body, wbits=GZIP_WBITS):
+        self.body = body
+        self.remaining = -1
+        self.until_close = False
+        self.done = False
+        self._feed = _InflateFeed(_INFLATE_LOOKAHEAD + 256)
+        self._inflate = deflate.DeflateIO(self._feed, deflate.GZIP, wbits)
+        self._out = bytearray(_INFLATE_STEP)
+        self._out_mv = memoryview(self._out)
+
+    async def _refill(self):
+        f = self._feed
+        while not f.eof and f.end - f.start < _INFLATE_LOOKAHEAD:
+            if f.start:
+                n = f.end - f.start
+                f.buf[:n] = f.mv[f.start : f.end]
+                f.start = 0
+                f.end = n
+            chunk = await self.body.readchunk(len(f.buf) - f.end)
+            if chunk == b"":
+                f.eof = True
+                break
+            f.buf[f.end : f.end + len(chunk)] = chunk
+            f.end += len(chunk)
+
+    async def readchunk(self, max_n):
+        if self.done:
+            return b""
+        await self._refill()
+        try:
+            n = self._inflate.readinto(self._out_mv[: min(max_n, _INFLATE_STEP)])
+        except (OSError, ValueError) as e:
+            raise InflateError("gzip inflate failed: {}".format(e))
+        if self._feed.underrun:
+            raise InflateError("gzip input underrun")
+        if n:
+            return self._out_mv[:n]
+        # End of the gzip member: drain any trailing bytes so the
+        # connection can be reused.
+        while await self.body.readchunk(256) != b"":
+            pass
+        self.done = self.body.done or self.body.until_close
+        return b""
+
+
+class Response:
+    def __init__(self, key, sock, reader, status, headers, body, reusable):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self._key = key
+        self._sock = sock
+        self._reader = reader
+        self._reusable = reusable
+
+    async def readchunk(self, max_n=512):
+        return await self.body.readchunk(max_n)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.body.readchunk(len(self._reader.buf))
+        if chunk == b"":
+            raise StopAsyncIteration
+        return chunk
+
+    async def save(self, file_path, append=False, bufsize=256):
+        with open(file_path, "ab" if append else "wb") as f:
             while True:
-                line = await reader.readline(limit=header_limit)
-                if not line or line in (b"\r\n", b"\n"):
-                    break
-                if content_length < 0:
-                    i = line.find(b":")
-                    if i >= 0 and line[:i].strip().lower() == b"content-length":
-                        try:
-                            content_length = int(line[i + 1 :].strip())
-                        except (ValueError, TypeError):
-                            pass
-
-        if save_to:
-            with open(save_to, "wb") as f:
-                while True:
-                    chunk = await reader.readchunk(bufsize)
-                    if chunk == b"":
-                        break
-                    f.write(chunk)
-                    await utils.ayield(do_gc=False)
-            del reader
-            gc.collect()
-            return status, resp_headers, None
-
-        if 0 < content_length <= max_body:
-            out = bytearray(content_length)
-            pos = 0
-            while pos < content_length:
-                chunk = await reader.readchunk(min(bufsize, content_length - pos))
+                chunk = await self.body.readchunk(bufsize)
                 if chunk == b"":
                     break
-                out[pos : pos + len(chunk)] = chunk
-                pos += len(chunk)
-            if pos < content_length:
-                out = out[:pos]
+                f.write(chunk)
+                await utils.ayield(do_gc=False)
+        # Complete when the framing saw its end; an unframed body can only be
+        # trusted up to the close.
+        return self.body.done or self.body.until_close
+
+    def close(self):
+        if self._sock is None:
+            return
+        if self._reusable and self.body.done:
+            _pool_release(self._key, self._sock)
         else:
-            out = bytearray()
-            while len(out) < max_body:
-                chunk = await reader.readchunk(min(bufsize, max_body - len(out)))
+            _close_quiet(self._sock)
+        self._sock = None
+        self._reader = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+
+
+def range_header(offset, end=None):
+    return "bytes={}-{}".format(offset, "" if end is None else end)
+
+
+def parse_content_range(value):
+    # b"bytes 100-199/1000" -> (100, 1000); total is -1 when reported as "*".
+    value = utils.to_str(value).strip()
+    if not value.startswith("bytes "):
+        return -1, -1
+    slash = value.find("/")
+    dash = value.find("-")
+    if slash < 0 or dash < 0:
+        return -1, -1
+    total = value[slash + 1 :]
+    try:
+        return int(value[6:dash]), (int(total) if total != "*" else -1)
+    except ValueError:
+        return -1, -1
+
+
+async def _read_body(body, save_to, bufsize, max_body):
+    if save_to:
+        with open(save_to, "wb") as f:
+            while True:
+                chunk = await body.readchunk(bufsize)
                 if chunk == b"":
                     break
-                out.extend(chunk)
-                if (len(out) & 0x3FF) == 0:
-                    await utils.ayield(len(out), every=1024, do_gc=False)
-        del reader
-        gc.collect()
-        return status, resp_headers, out
+                f.write(chunk)
+                await utils.ayield(do_gc=False)
+        return None
+
+    if 0 < body.remaining <= max_body:
+        content_length = body.remaining
+        out = bytearray(content_length)
+        pos = 0
+        while pos < content_length:
+            chunk = await body.readchunk(bufsize)
+            if chunk == b"":
+                break
+            out[pos : pos + len(chunk)] = chunk
+            pos += len(chunk)
+        if pos < content_length:
+            out = out[:pos]
+        return out
+
+    out = bytearray()
+    while len(out) < max_body:
+        chunk = await body.readchunk(min(bufsize, max_body - len(out)))
+        if chunk == b"":
+            break
+        out.extend(chunk)
+        if (len(out) & 0x3FF) == 0:
+            await utils.ayield(len(out), every=1024, do_gc=False)
+    return out
+
+
+async def _open_response(
+    method, url, headers, body, bufsize, collect_headers, header_limit, keep_alive, skip_headers, accept_gzip
+):
+    headers = headers or {}
+    accept_gzip = accept_gzip and deflate is not None
+    if accept_gzip:
+        headers = dict(headers)
+        headers["Accept-Encoding"] = "gzip"
+        skip_headers = False
+    scheme, host, port, path = _parse_url(url)
+    use_ssl = scheme == "https"
+    method = utils.to_bytes(method)
+    b = utils.to_bytes(body) if body is not None else b""
+    key = (use_ssl, host, port)
+
+    for attempt in range(2):
+        s = _pool_acquire(key) if keep_alive else None
+        reused = s is not None
+        if s is None:
+            s = await _open(host, port, use_ssl)
+
+        try:
+            try:
+                await _send_request(s, method, host, path, headers, b, keep_alive)
+                reader = _BufferedSock(s, bufsize=bufsize)
+                status_line = await reader.readline(limit=256)
+                if not status_line:
+                    raise OSError(-1, "Connection closed by host")
+            except OSError:
+                _close_quiet(s)
+                if not reused:
+                    # A non-blocking connect only fails here, on first use.
+                    utils.forget_address(host, port)
+                # A pooled socket may have been closed by the server while idle:
+                # retry idempotent requests once on a fresh connection.
+                if reused and attempt == 0 and method in _IDEMPOTENT:
+                    continue
+                raise
+            status = _parse_status(status_line)
+
+            if skip_headers and not keep_alive:
+                resp_headers = {}
+                content_length = -1
+                conn_close = True
+                chunked = False
+                gzip = False
+                await reader.skip_headers()
+            else:
+                resp_headers, content_length, conn_close, chunked, gzip = await _read_headers(
+                    reader, collect_headers, header_limit
+                )
+        except BaseException:
+            _close_quiet(s)
+            raise
+
+        if status in (204, 304) or method == b"HEAD":
+            content_length, chunked = 0, False
+        reusable = keep_alive and not conn_close and status_line.startswith(b"HTTP/1.1")
+        body_reader = _BodyReader(reader, content_length, chunked)
+        reusable = reusable and not body_reader.until_close
+        if gzip and accept_gzip and not body_reader.done:
+            body_reader = _InflateReader(body_reader)
+        return Response(key, s, reader, status, resp_headers, body_reader, reusable)
+
+
+async def stream(
+    method,
+    url,
+    headers=None,
+    body=None,
+    *,
+    bufsize=512,
+    header_limit=2048,
+    keep_alive=False,
+    accept_gzip=False,
+):
+    return await _open_response(
+        method, url, headers, body, bufsize, True, header_limit, keep_alive, False, accept_gzip
+    )
+
+
+async def request(
+    method,
+    url,
+    headers=None,
+    body=None,
+    *,
+    save_to=None,
+    bufsize=256,
+    max_body=64_000,
+    collect_headers=True,
+    header_limit=2048,
+    keep_alive=False,
+    accept_gzip=False,
+):
+    resp = await _open_response(
+        method, url, headers, body, bufsize, collect_headers, header_limit, keep_alive,
+        bool(save_to) and not collect_headers, accept_gzip,
+    )
+    try:
+        out = await _read_body(resp.body, save_to, bufsize, max_body)
+        status, resp_headers = resp.status, resp.headers
     finally:
-        s.close()
+        resp.close()
+    del resp
+    gc.collect()
+    return status, resp_headers, out
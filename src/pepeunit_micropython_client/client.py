@@ -14,7 +14,7 @@ from .schema_manager import SchemaManager
 
 from .pepeunit_mqtt_client import PepeunitMqttClient
 from .pepeunit_rest_client import PepeunitRestClient
-from .enums import BaseInputTopicType, BaseOutputTopicType, RestartMode
+from .enums import BaseInputTopicType, BaseOutputTopicType, DestinationTopicType, RestartMode, QueuePolicy, PayloadDecoder
 
 
 class PepeunitClient:
@@ -31,6 +31,12 @@ class PepeunitClient:
         ff_console_log_enable=True,
         ff_mqtt_log_enable=True,
         ff_file_log_enable=True,
+        publish_queue_size=0,
+        publish_queue_policy=QueuePolicy.DROP_OLDEST,
+        input_queue_size=4,
+        input_queue_policy=QueuePolicy.DROP_OLDEST,
+        offline_store_path=None,
+        offline_store_max_bytes=32768,
     ):
         self.env_file_path = env_file_path
         self.schema_file_path = schema_file_path
@@ -52,6 +58,12 @@ class PepeunitClient:
                 ff_file_log_enable,
             )
         self.mqtt_client = PepeunitMqttClient(self.settings, self.schema, self.logger)
+        self.mqtt_client.set_input_queue(input_queue_size, input_queue_policy)
+        if publish_queue_size:
+            self.mqtt_client.enable_publish_queue(publish_queue_size, publish_queue_policy)
+        if offline_store_path:
+            from .offline_store import OfflineStore
+            self.mqtt_client.enable_offline_store(OfflineStore(offline_store_path, offline_store_max_bytes))
         self.logger.mqtt_client = self.mqtt_client
         self.rest_client = PepeunitRestClient(self.settings)
 
@@ -63,6 +75,7 @@ class PepeunitClient:
         self.mqtt_client.set_wifi_manager(self.wifi_manager)
 
         self.mqtt_input_handler = None
+        self._input_routes = {}
         self.mqtt_output_handler = None
         self.custom_update_handler = None
 
@@ -77,7 +90,8 @@ class PepeunitClient:
             'mem_alloc': gc.mem_alloc(),
             'freq': machine.freq(),
             'statvfs': os.statvfs('/'),
-            'pu_commit_version': self.settings.PU_COMMIT_VERSION
+            'pu_commit_version': self.settings.PU_COMMIT_VERSION,
+            'mqtt_input_dropped': self.mqtt_client.input_queue_dropped,
         }
 
         if self.wifi_manager:
@@ -87,45 +101,97 @@ class PepeunitClient:
 
         return state
 
-    def set_mqtt_input_handler(self, handler):
+    def set_mqtt_input_handler(self, handler, workers=1, mem_budget=8000):
         self.mqtt_input_handler = handler
-        async def combined_handler(msg):
-            try:
-                self._base_mqtt_input_func(msg)
-                if self.mqtt_input_handler:
-                    await self.mqtt_input_handler(self, msg)
-            except Exception as e:
-                self.logger.error('Error in MQTT handler: ' + str(e))
-        self.mqtt_client.set_input_handler(combined_handler)
+        self.mqtt_client.set_input_workers(workers, mem_budget)
+        self.mqtt_client.set_input_handler(self._combined_input_handler)
+
+    def set_mqtt_input_view_handler(self, handler):
+        self.mqtt_client.set_input_view_handler(self._make_view_handler(handler) if handler else None)
+        if self.mqtt_client.is_connected():
+            self.mqtt_client.mark_disconnected("input view mode changed")
+
+    def _make_view_handler(self, handler):
+        def view_handler(view):
+            if view.section == DestinationTopicType.INPUT_BASE_TOPIC:
+                utils.spawn(self._combined_input_handler(view.detach()))
+                return
+            handler(self, view)
+        return view_handler
+
+    def on_input(self, topic_key, handler, decoder=PayloadDecoder.RAW):
+        if handler is None:
+            self._input_routes.pop(topic_key, None)
+        else:
+            self._input_routes[topic_key] = (handler, decoder)
+        self.mqtt_client.set_input_handler(self._combined_input_handler)
+
+    @staticmethod
+    def _decode_payload(decoder, payload):
+        if decoder == PayloadDecoder.RAW:
+            return payload
+        if decoder == PayloadDecoder.STR:
+            return utils.to_str(payload)
+        if decoder == PayloadDecoder.INT:
+            return int(utils.to_str(payload))
+        if decoder == PayloadDecoder.FLOAT:
+            return float(utils.to_str(payload))
+        if decoder == PayloadDecoder.JSON:
+            return json.loads(payload)
+        return decoder(payload)
+
+    async def _combined_input_handler(self, msg):
+        try:
+            self._base_mqtt_input_func(msg)
+            route = self._input_routes.get(msg.topic_key) if msg.topic_key else None
+            if route:
+                handler, decoder = route
+                try:
+                    if msg.spool_path is None:
+                        msg.payload = self._decode_payload(decoder, msg.payload)
+                except Exception as e:
+                    self.logger.error('Decode error for {}: {}'.format(msg.topic_key, e))
+                    return
+                await handler(self, msg)
+            elif self.mqtt_input_handler:
+                await self.mqtt_input_handler(self, msg)
+        except Exception as e:
+            self.logger.error('Error in MQTT handler: ' + str(e))
 
     def _base_mqtt_input_func(self, msg):
+        if msg.section != DestinationTopicType.INPUT_BASE_TOPIC:
+            return
         try:
-            for topic_key in self.schema.input_base_topic:
-                if msg.topic in self.schema.input_base_topic[topic_key]:
-                    self.logger.info('Get base MQTT command: {}'.format(topic_key))
-
-                    if topic_key == BaseInputTopicType.ENV_UPDATE_PEPEUNIT:
-                        asyncio.create_task(self.download_env(self.env_file_path))
-                    elif topic_key == BaseInputTopicType.SCHEMA_UPDATE_PEPEUNIT:
-                        asyncio.create_task(self.download_schema(self.schema_file_path))
-                    elif topic_key == BaseInputTopicType.UPDATE_PEPEUNIT:
-                        self._handle_update(msg)
-                    elif topic_key == BaseInputTopicType.LOG_SYNC_PEPEUNIT:
-                        self._handle_log_sync()
-                    break
+            topic_key = msg.topic_key
+            self.logger.info('Get base MQTT command: {}'.format(topic_key))
+
+            if topic_key == BaseInputTopicType.ENV_UPDATE_PEPEUNIT:
+                asyncio.create_task(self.download_env(self.env_file_path))
+            elif topic_key == BaseInputTopicType.SCHEMA_UPDATE_PEPEUNIT:
+                asyncio.create_task(self.download_schema(self.schema_file_path))
+            elif topic_key == BaseInputTopicType.UPDATE_PEPEUNIT:
+                self._handle_update(msg)
+            elif topic_key == BaseInputTopicType.LOG_SYNC_PEPEUNIT:
+                self._handle_log_sync()
         except Exception as e:
             self.logger.error('Error in base MQTT command: ' + str(e))
 
     async def download_env(self, file_path):
-        await self.rest_client.download_env(file_path)
+        if not await self.rest_client.download_env(file_path):
+            self.logger.info('Env not modified')
+            return False
         self.settings.load_from_file()
         self.logger.info('Success update env')
+        return True
 
     async def download_schema(self, file_path):
-        await self.rest_client.download_schema(file_path)
+        if not await self.rest_client.download_schema(file_path):
+            self.logger.info('Schema not modified')
+            return False
         self.schema.update_from_file()
         self._resubscribe_requested = True
         self.logger.info('Success update schema')
+        return True
 
     async def set_state_storage(self, state):
         await self.rest_client.set_state_storage(state)
@@ -182,7 +248,7 @@ class PepeunitClient:
         self._resubscribe_requested = True
 
     async def publish_to_topics(self, topic_key, message):
-        topics = self.schema.output_topic.get(topic_key) or self.schema.output_base_topic.get(topic_key)
+        topics = self.schema.get_output_handles(topic_key)
         if not topics:
             self.logger.warning("No MQTT topics for key: {}".format(topic_key), file_only=True)
             return False
@@ -203,9 +269,9 @@ class PepeunitClient:
         self._last_state_send = current_time
         if not utils.ensure_memory(6000):
             return None
-        topic = self.schema.output_base_topic[BaseOutputTopicType.STATE_PEPEUNIT][0]
+        topic = self.schema.get_output_handles(BaseOutputTopicType.STATE_PEPEUNIT)[0]
         print("STATE_SEND")
-        return self.mqtt_client.publish(topic, json.dumps(self.get_system_state()))
+        return self.mqtt_client.publish(topic, json.dumps(self.get_system_state()), store=False)
 
     async def run_main_cycle(self, cycle_ms=20):
         self._running = True
@@ -214,6 +280,7 @@ class PepeunitClient:
                 await self.mqtt_client.ensure_connected()
                 if self.mqtt_client.consume_reconnected():
                     self._resubscribe_requested = True
+                    utils.spawn(self.mqtt_client.replay_offline_store())
                 if self._resubscribe_requested and self.mqtt_client.is_connected():
                     try:
                         async with self.mqtt_client.drop_input():
@@ -46,3 +46,18 @@ class BaseOutputTopicType:
 class RestartMode:
     RESTART_EXEC = 'restart_exec'
     NO_RESTART = 'no_restart'
+
+
+class QueuePolicy:
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    BLOCK = 'block'
+    COALESCE_BY_TOPIC = 'coalesce_by_topic'
+
+
+class PayloadDecoder:
+    RAW = 'raw'
+    STR = 'str'
+    INT = 'int'
+    FLOAT = 'float'
+    JSON = 'json'
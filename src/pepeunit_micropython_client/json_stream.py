@@ -0,0 +1,125 @@
+import ujson as json
+import utils
+
+
+_LBRACE = 0x7B
+_RBRACE = 0x7D
+_LBRACK = 0x5B
+_RBRACK = 0x5D
+_QUOTE = 0x22
+_BSLASH = 0x5C
+_COMMA = 0x2C
+_COLON = 0x3A
+_WS = b" \t\r\n"
+
+
+class JsonArrayStream:
+    # Incremental JSON scanner. Raw bytes are fed in any chunking; each
+    # element of the array at `path` ("units[*]", "a.b[*]", "[*]" for a root
+    # array) is decoded on its own and handed to on_item, so peak heap is one
+    # element rather than the whole body. Top-level scalar fields such as
+    # "count" are collected in `fields`; other values are skipped unparsed.
+    def __init__(self, path, on_item, max_item=4096):
+        if not path.endswith('[*]'):
+            raise ValueError("Array path must end with [*]: {}".format(path))
+        head = path[:-3]
+        self._path = [k.encode() for k in head.split('.')] if head else []
+        self._key_depth = max(len(self._path), 1)
+        self._on_item = on_item
+        self.max_item = max_item
+        self.fields = {}
+        self.items = 0
+        self._stack = bytearray()
+        self._keys = []
+        self._in_str = False
+        self._esc = False
+        self._want_key = False
+        self._key = None
+        self._target = -1
+        self._item = None
+        self._field = None
+        self._started = False
+
+    @property
+    def complete(self):
+        return self._started and not self._stack
+
+    def _matches(self):
+        if len(self._stack) != len(self._path):
+            return False
+        for i, k in enumerate(self._path):
+            if self._stack[i] != _LBRACE or self._keys[i] != k:
+                return False
+        return True
+
+    def _emit(self):
+        item = self._item
+        self._item = None
+        self.items += 1
+        self._on_item(json.loads(item))
+
+    def feed(self, chunk):
+        stack = self._stack
+        for c in chunk:
+            depth = len(stack)
+
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == _BSLASH:
+                    self._esc = True
+                elif c == _QUOTE:
+                    self._in_str = False
+                    if self._key is not None:
+                        self._keys[-1] = bytes(self._key)
+                        self._key = None
+                elif self._key is not None:
+                    self._key.append(c)
+                if self._item is not None:
+                    self._item.append(c)
+                elif self._field is not None:
+                    self._field.append(c)
+                continue
+
+            if depth == self._target:
+                if self._item is not None and (c == _COMMA or c == _RBRACK):
+                    self._emit()
+                elif self._item is None and c not in _WS and c != _COMMA and c != _RBRACK:
+                    self._item = bytearray()
+            if self._item is not None:
+                self._item.append(c)
+                if len(self._item) > self.max_item:
+                    raise ValueError("JSON item exceeds {} bytes".format(self.max_item))
+
+            if self._field is not None and depth == 1:
+                if c == _COMMA or c == _RBRACE:
+                    self.fields[utils.to_str(self._keys[0])] = json.loads(self._field)
+                    self._field = None
+                elif c == _LBRACE or c == _LBRACK:
+                    self._field = None
+                else:
+                    self._field.append(c)
+
+            if c == _QUOTE:
+                self._in_str = True
+                if self._want_key:
+                    self._want_key = False
+                    if depth <= self._key_depth:
+                        self._key = bytearray()
+            elif c == _LBRACE or c == _LBRACK:
+                if c == _LBRACK and self._target < 0 and self._matches():
+                    self._target = depth + 1
+                stack.append(c)
+                self._keys.append(None)
+                self._want_key = c == _LBRACE
+                self._started = True
+            elif c == _RBRACE or c == _RBRACK:
+                if depth == self._target:
+                    self._target = -1
+                stack.pop()
+                self._keys.pop()
+                self._want_key = False
+            elif c == _COMMA:
+                self._want_key = depth > 0 and stack[-1] == _LBRACE
+            elif c == _COLON and depth == 1 and stack[0] == _LBRACE:
+                self._field = bytearray()
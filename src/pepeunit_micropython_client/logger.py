@@ -73,8 +73,8 @@ class Logger:
                     pass
                 self._rotate_if_needed()
             if needs_mqtt:
-                topic = self.schema_manager.output_base_topic[BaseOutputTopicType.LOG_PEPEUNIT][0]
-                await self.mqtt_client.publish(topic, log_entry)
+                topic = self.schema_manager.get_output_handles(BaseOutputTopicType.LOG_PEPEUNIT)[0]
+                await self.mqtt_client.publish(topic, log_entry, store=False)
 
     def _rotate_if_needed(self):
         try:
@@ -112,12 +112,12 @@ class Logger:
             return
         if BaseOutputTopicType.LOG_PEPEUNIT not in self.schema_manager.output_base_topic:
             return
-        topic = self.schema_manager.output_base_topic[BaseOutputTopicType.LOG_PEPEUNIT][0]
+        topic = self.schema_manager.get_output_handles(BaseOutputTopicType.LOG_PEPEUNIT)[0]
 
         self._sync_busy = True
         try:
             async def on_line(line):
-                await self.mqtt_client.publish(topic, line)
+                await self.mqtt_client.publish(topic, line, store=False)
                 utils.ensure_memory(8000)
                 await asyncio.sleep_ms(50)
 
@@ -0,0 +1,210 @@
+import os
+import struct
+import uasyncio as asyncio
+import utils
+
+from .enums import QueuePolicy
+
+
+# Record: flags (retain | qos << 1), topic length, payload length, topic, payload.
+# Segments are only ever appended to and removed whole once replayed, so
+# flash pages are never rewritten in place.
+_HDR = '<BHH'
+_HDR_SIZE = 5
+_SEG_SUFFIX = '.seg'
+# Replay progress of a segment: <seq>.ack gets the byte offset replayed so far
+# appended once per batch and is removed together with the segment, so after
+# a reboot at most one batch is sent again.
+_ACK = '<I'
+_ACK_SUFFIX = '.ack'
+# Empty <seq>.end marker left when the store drains, so segment numbers keep
+# increasing across reboots and a new segment never reuses an old number.
+_END_SUFFIX = '.end'
+
+
+class OfflineStore:
+    def __init__(self, dir_path, max_bytes=32768, segment_size=4096, policy=QueuePolicy.DROP_OLDEST):
+        self.dir_path = dir_path
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.policy = policy
+        self.dropped = 0
+        self.evicted = 0
+        self._segments = []
+        self._size = 0
+        self._tail_size = 0
+        self._read_offset = 0
+        self._next_seq = 0
+        self._end_seq = None
+        self._load()
+
+    def _path(self, seq, suffix):
+        return '{}/{:08d}{}'.format(self.dir_path, seq, suffix)
+
+    def _seg_path(self, seq):
+        return self._path(seq, _SEG_SUFFIX)
+
+    def _seg_size(self, seq):
+        try:
+            return os.stat(self._seg_path(seq))[6]
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _load(self):
+        try:
+            os.mkdir(self.dir_path)
+        except OSError:
+            pass
+        acks = []
+        for name in os.listdir(self.dir_path):
+            try:
+                seq = int(name[:-4])
+            except ValueError:
+                continue
+            if name.endswith(_SEG_SUFFIX):
+                self._segments.append(seq)
+            elif name.endswith(_ACK_SUFFIX):
+                acks.append(seq)
+            elif name.endswith(_END_SUFFIX):
+                if self._end_seq is not None:
+                    self._remove(self._path(self._end_seq, _END_SUFFIX))
+                    seq = max(seq, self._end_seq)
+                self._end_seq = seq
+            else:
+                continue
+            if seq >= self._next_seq:
+                self._next_seq = seq + 1
+        self._segments.sort()
+        for seq in acks:
+            if seq not in self._segments:
+                self._remove(self._path(seq, _ACK_SUFFIX))
+        for seq in self._segments:
+            self._size += self._seg_size(seq)
+        if self._segments:
+            self._tail_size = self._seg_size(self._segments[-1])
+            self._load_progress()
+
+    def _load_progress(self):
+        seq = self._segments[0]
+        try:
+            with open(self._path(seq, _ACK_SUFFIX), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+        n = len(data) // 4 * 4
+        if n:
+            offset = struct.unpack(_ACK, data[n - 4 : n])[0]
+            if offset <= self._seg_size(seq):
+                self._read_offset = offset
+
+    def _save_progress(self, seq):
+        try:
+            with open(self._path(seq, _ACK_SUFFIX), 'ab') as f:
+                f.write(struct.pack(_ACK, self._read_offset))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return self._size
+
+    def has_data(self):
+        return bool(self._segments)
+
+    def _remove_oldest(self):
+        seq = self._segments.pop(0)
+        self._size -= self._seg_size(seq)
+        if not self._segments:
+            self._set_end(seq)
+        self._remove(self._seg_path(seq))
+        self._remove(self._path(seq, _ACK_SUFFIX))
+        self._read_offset = 0
+        if not self._segments:
+            self._size = 0
+            self._tail_size = 0
+
+    def _set_end(self, seq):
+        try:
+            open(self._path(seq, _END_SUFFIX), 'wb').close()
+        except OSError:
+            return
+        if self._end_seq is not None and self._end_seq != seq:
+            self._remove(self._path(self._end_seq, _END_SUFFIX))
+        self._end_seq = seq
+
+    def append(self, topic, message, retain=False, qos=0):
+        topic = utils.to_bytes(topic)
+        message = utils.to_bytes(message)
+        rec_size = _HDR_SIZE + len(topic) + len(message)
+        if rec_size > self.segment_size or rec_size > self.max_bytes:
+            self.dropped += 1
+            return False
+
+        while self._size + rec_size > self.max_bytes:
+            if self.policy == QueuePolicy.DROP_NEWEST or not self._segments:
+                self.dropped += 1
+                return False
+            self._remove_oldest()
+            self.evicted += 1
+
+        if not self._segments or self._tail_size + rec_size > self.segment_size:
+            self._segments.append(self._next_seq)
+            self._next_seq += 1
+            self._tail_size = 0
+
+        try:
+            with open(self._seg_path(self._segments[-1]), 'ab') as f:
+                f.write(struct.pack(_HDR, (1 if retain else 0) | (qos << 1), len(topic), len(message)))
+                f.write(topic)
+                f.write(message)
+        except OSError:
+            self.dropped += 1
+            return False
+
+        self._tail_size += rec_size
+        self._size += rec_size
+        return True
+
+    async def replay(self, publish, batch=8, interval_ms=100):
+        sent = 0
+        while self._segments:
+            seq = self._segments[0]
+            if seq == self._segments[-1]:
+                # Seal the tail: records appended while we publish go to a
+                # new segment instead of a file that is about to be removed.
+                self._tail_size = self.segment_size
+            with open(self._seg_path(seq), 'rb') as f:
+                f.seek(self._read_offset)
+                while True:
+                    hdr = f.read(_HDR_SIZE)
+                    if len(hdr) < _HDR_SIZE:
+                        break
+                    flags, t_len, m_len = struct.unpack(_HDR, hdr)
+                    topic = f.read(t_len)
+                    message = f.read(m_len)
+                    if len(topic) < t_len or len(message) < m_len:
+                        # Torn tail record from a power loss during append.
+                        break
+                    ok = await publish(topic, message, bool(flags & 1), (flags >> 1) & 1)
+                    if not self._segments or self._segments[0] != seq:
+                        # Evicted by append() while publishing.
+                        break
+                    if not ok:
+                        self._save_progress(seq)
+                        return sent
+                    self._read_offset += _HDR_SIZE + t_len + m_len
+                    sent += 1
+                    if sent % batch == 0:
+                        self._save_progress(seq)
+                        await asyncio.sleep_ms(interval_ms)
+                    else:
+                        await utils.ayield(do_gc=False)
+            if self._segments and self._segments[0] == seq:
+                self._remove_oldest()
+        return sent
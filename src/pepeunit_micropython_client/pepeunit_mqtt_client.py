@@ -1,12 +1,42 @@
+import os
 import time
 import uasyncio as asyncio
 import utils
 
-from mqtt_as import MQTTClient
+from mqtt_as import MQTTClient, PubTopic, STALE_INTERVALS
+
+from .enums import QueuePolicy, DestinationTopicType
+from .ring_buffer import RingBuffer
 
 
 class _Msg:
-    __slots__ = ("topic", "payload", "retained", "properties")
+    __slots__ = ("topic", "topic_key", "section", "payload", "retained", "properties", "spool_path")
+
+
+class _MsgView:
+    __slots__ = ("topic", "topic_key", "section", "payload", "retained", "properties")
+
+    def detach(self):
+        m = _Msg()
+        m.topic = utils.to_str(self.topic)
+        m.topic_key = self.topic_key
+        m.section = self.section
+        m.payload = bytes(self.payload)
+        m.retained = self.retained
+        m.properties = self.properties
+        m.spool_path = None
+        return m
+
+
+_NO_ENTRY = (None, None)
+# Each spooled payload gets its own file, removed once its handler has run or
+# the message is dropped from the queue. At most this many exist at a time;
+# further oversized messages are dropped until one is released.
+_SPOOL_SLOTS = 4
+
+
+def _msg_topic(msg):
+    return msg.topic
 
 
 class _InputDropContext:
@@ -42,9 +72,28 @@ class PepeunitMqttClient:
         self.logger = logger
 
         self._input_handler = None
+        self._view_handler = None
+        self._view = _MsgView()
         self._drop_input_refcount = 0
-        self._input_busy = False
+        self._spool_file = None
+        self._spool_path = None
+        self._spool_seq = 0
+        self._spool_live = 0
+        self._spool_dropped = 0
+        self._input_queue_size = 4
+        self._input_queue_policy = QueuePolicy.DROP_OLDEST
+        self._input_workers = 1
+        self._input_mem_budget = 8000
+        self._input_inflight = 0
+        self._input_done = asyncio.Event()
+        self._input_queues = None
+        self._input_tasks = []
+        self._reset_input_workers()
         self._publish_lock = asyncio.Lock()
+        self._publish_queue = None
+        self._sender_task = None
+        self._offline_store = None
+        self._replay_busy = False
 
         self._client = None
         self._wifi_manager = None
@@ -56,6 +105,72 @@ class PepeunitMqttClient:
     def set_wifi_manager(self, wifi_manager):
         self._wifi_manager = wifi_manager
 
+    def enable_publish_queue(self, size=16, policy=QueuePolicy.DROP_OLDEST):
+        if self._sender_task:
+            self._sender_task.cancel()
+            self._sender_task = None
+        if size <= 0:
+            self._publish_queue = None
+            return
+        self._publish_queue = RingBuffer(size, policy)
+
+    def enable_offline_store(self, store):
+        self._offline_store = store
+
+    @property
+    def offline_store(self):
+        return self._offline_store
+
+    async def replay_offline_store(self, batch=8, interval_ms=100):
+        store = self._offline_store
+        if not store or self._replay_busy or not store.has_data():
+            return 0
+        self._replay_busy = True
+        try:
+            sent = await store.replay(self._publish_now, batch, interval_ms)
+            self.logger.info("Replayed {} stored MQTT messages".format(sent), file_only=True)
+            return sent
+        finally:
+            self._replay_busy = False
+
+    def _reset_input_workers(self):
+        for task in self._input_tasks:
+            task.cancel()
+        self._input_tasks = []
+        for q in self._input_queues or ():
+            while len(q):
+                self._release_spool(q.get_nowait())
+        self._input_queues = [
+            RingBuffer(self._input_queue_size, self._input_queue_policy, self._release_spool)
+            for _ in range(self._input_workers)
+        ]
+
+    def set_input_queue(self, size=4, policy=QueuePolicy.DROP_OLDEST):
+        self._input_queue_size = size
+        self._input_queue_policy = policy
+        self._reset_input_workers()
+
+    def set_input_workers(self, workers=1, mem_budget=8000):
+        self._input_workers = workers if workers > 0 else 1
+        self._input_mem_budget = mem_budget
+        self._reset_input_workers()
+
+    @property
+    def input_queue_depth(self):
+        return sum(len(q) for q in self._input_queues)
+
+    @property
+    def input_queue_dropped(self):
+        return self._spool_dropped + sum(q.dropped for q in self._input_queues)
+
+    @property
+    def publish_queue_depth(self):
+        return len(self._publish_queue) if self._publish_queue else 0
+
+    @property
+    def publish_queue_dropped(self):
+        return self._publish_queue.dropped if self._publish_queue else 0
+
     @property
     def connection_state(self):
         return self._state
@@ -104,7 +219,7 @@ class PepeunitMqttClient:
             self._reconnect_attempt = 0
             return False
 
-        stale_ms = ping_ms * 2
+        stale_ms = ping_ms * STALE_INTERVALS
         if time.ticks_diff(now, last_rx) <= stale_ms:
             self._reconnect_attempt = 0
             return False
@@ -148,26 +263,136 @@ class PepeunitMqttClient:
     def _on_message(self, topic, msg, retained=False, properties=None):
         if self._drop_input_refcount or not self._input_handler:
             return
-        if self._input_busy:
-            print("THROTTLE DROP MQTT INPUT")
-            return
+        self._enqueue_input(topic, msg, retained, properties, None)
+
+    def _enqueue_input(self, topic, payload, retained, properties, spool_path):
         m = _Msg()
         m.topic = utils.to_str(topic)
-        m.payload = msg
+        m.section, m.topic_key = self.schema_manager.lookup_topic(m.topic) or _NO_ENTRY
+        m.payload = payload
         m.retained = retained
         m.properties = properties
-        self._input_busy = True
-        utils.spawn(self._run_input_handler(m))
+        m.spool_path = spool_path
+        # Same topic always lands in the same worker queue, which keeps
+        # per-topic ordering while different topics run in parallel.
+        queues = self._input_queues
+        n = len(queues)
+        queues[hash(m.topic) % n if n > 1 else 0].put_nowait(m, _msg_topic)
+        if not self._input_tasks:
+            self._input_tasks = [asyncio.create_task(self._input_loop(q)) for q in queues]
+
+    def _close_spool(self):
+        if self._spool_file:
+            try:
+                self._spool_file.close()
+            except OSError:
+                pass
+            self._spool_file = None
 
-    async def _run_input_handler(self, msg):
+    def _remove_spool_file(self, path):
         try:
-            await self._input_handler(msg)
-        finally:
-            self._input_busy = False
+            os.remove(path)
+        except OSError:
+            pass
+        self._spool_live -= 1
+
+    def _discard_spool(self):
+        # Drops a partially written spool file (stream cut short or write error).
+        self._close_spool()
+        if self._spool_path:
+            self._remove_spool_file(self._spool_path)
+            self._spool_path = None
+
+    def _release_spool(self, msg):
+        if msg.spool_path:
+            self._remove_spool_file(msg.spool_path)
+            msg.spool_path = None
+
+    def _on_chunk(self, topic, chunk, offset, total, retained=False):
+        if self._drop_input_refcount or not self._input_handler:
+            return
+        if offset == 0:
+            self._discard_spool()
+            section, _ = self.schema_manager.lookup_topic(utils.to_str(topic)) or _NO_ENTRY
+            if section == DestinationTopicType.INPUT_BASE_TOPIC:
+                # Base commands are parsed from msg.payload; never hand them
+                # over as a spool file.
+                self._spool_dropped += 1
+                self.logger.warning("Oversized base command dropped: {}".format(utils.to_str(topic)), file_only=True)
+                return
+            if self._spool_live >= _SPOOL_SLOTS:
+                self._spool_dropped += 1
+                return
+            self._spool_seq += 1
+            path = "{}_{}.bin".format(self.settings.PUC_MQTT_SPOOL_PATH, self._spool_seq)
+            try:
+                self._spool_file = open(path, "wb")
+            except OSError as e:
+                self._spool_dropped += 1
+                self.logger.warning("MQTT spool open failed: {}".format(e), file_only=True)
+                return
+            self._spool_path = path
+            self._spool_live += 1
+        if not self._spool_file:
+            return
+        try:
+            self._spool_file.write(chunk)
+        except OSError as e:
+            self._discard_spool()
+            self._spool_dropped += 1
+            self.logger.warning("MQTT spool write failed: {}".format(e), file_only=True)
+            return
+        if offset + len(chunk) >= total:
+            self._close_spool()
+            path = self._spool_path
+            self._spool_path = None
+            self._enqueue_input(topic, None, retained, None, path)
+
+    async def _input_loop(self, queue):
+        while True:
+            msg = await queue.get()
+            if not self._input_handler:
+                continue
+            # Memory is only freed by a running handler, so recheck when one ends.
+            while self._input_inflight and not utils.ensure_memory(self._input_mem_budget):
+                self._input_done.clear()
+                await self._input_done.wait()
+            self._input_inflight += 1
+            try:
+                await self._input_handler(msg)
+            except Exception as e:
+                self.logger.error("MQTT input handler failed: {}".format(e))
+            finally:
+                self._input_inflight -= 1
+                self._input_done.set()
+                self._release_spool(msg)
+            del msg
+            await utils.ayield(do_gc=False)
 
     def set_input_handler(self, handler):
         self._input_handler = handler
 
+    def set_input_view_handler(self, handler):
+        # Takes effect on the next connect: the MQTT client must deliver views.
+        self._view_handler = handler
+
+    def _on_message_view(self, topic, msg, retained=False, properties=None):
+        if self._drop_input_refcount:
+            return
+        v = self._view
+        v.section, v.topic_key = self.schema_manager.lookup_topic_view(topic) or _NO_ENTRY
+        v.topic = topic
+        v.payload = msg
+        v.retained = retained
+        v.properties = properties
+        try:
+            self._view_handler(v)
+        except Exception as e:
+            self.logger.error("MQTT view handler failed: {}".format(e))
+        finally:
+            v.topic = None
+            v.payload = None
+
     async def connect(self):
         if self.is_connected():
             return
@@ -178,9 +403,13 @@ class PepeunitMqttClient:
             password=b"",
             keepalive=self.settings.PU_MQTT_KEEPALIVE,
             ping_interval=self.settings.PU_MQTT_PING_INTERVAL,
+            max_inflight=self.settings.PUC_MQTT_MAX_INFLIGHT,
             client_id=utils.to_bytes(self.settings.unit_uuid),
-            subs_cb=self._on_message,
+            subs_cb=self._on_message_view if self._view_handler else self._on_message,
             should_drop=lambda: bool(self._drop_input_refcount),
+            zero_copy=bool(self._view_handler),
+            max_payload=self.settings.PUC_MQTT_MAX_PAYLOAD,
+            chunk_cb=self._on_chunk,
         )
         await self._client.connect()
         self._state = self.CONNECTED
@@ -199,26 +428,69 @@ class PepeunitMqttClient:
         if not self.is_connected():
             return
         try:
-            idx = 0
+            started = time.ticks_ms()
+            topics = []
             for section in (self.schema_manager.input_base_topic, self.schema_manager.input_topic):
                 for topic_list in section.values():
                     for topic in topic_list:
-                        await self._client.subscribe(utils.to_bytes(topic), qos=0)
-                        idx += 1
-                        await utils.ayield(idx, every=4, do_gc=True)
-            self.logger.info("Subscribed to {} topics".format(idx))
+                        topics.append(utils.to_bytes(topic))
+                        await utils.ayield(len(topics), every=32, do_gc=False)
+            packets = await self._client.subscribe_many(
+                topics, qos=0, max_packet=self.settings.PUC_MQTT_SUB_PACKET_SIZE
+            )
+            self.logger.info(
+                "Subscribed to {} topics in {} ms ({} packets)".format(
+                    len(topics), time.ticks_diff(time.ticks_ms(), started), packets
+                )
+            )
         except Exception as e:
             self.mark_disconnected("subscribe failed: {}".format(e))
 
-    async def publish(self, topic, message, retain=False, qos=0):
+    async def _publish_call(self, topic, message, retain, qos):
         if not self._can_publish():
             return False
+        try:
+            if not isinstance(topic, PubTopic):
+                topic = utils.to_bytes(topic)
+            await self._client.publish(topic, utils.to_bytes(message), retain=retain, qos=qos)
+            return True
+        except Exception as e:
+            self.mark_disconnected("publish failed: {}".format(e))
+            return False
+
+    async def _publish_now(self, topic, message, retain, qos):
+        if qos:
+            # QoS 1 completion is bounded by the MQTTClient in-flight window,
+            # so several publishes may wait for PUBACK at the same time.
+            return await self._publish_call(topic, message, retain, qos)
         async with self._publish_lock:
-            if not self._can_publish():
-                return False
-            try:
-                await self._client.publish(utils.to_bytes(topic), utils.to_bytes(message), retain=retain, qos=qos)
-                return True
-            except Exception as e:
-                self.mark_disconnected("publish failed: {}".format(e))
-                return False
+            return await self._publish_call(topic, message, retain, qos)
+
+    async def _publish_async(self, queue, topic, message, retain, qos):
+        if not await self._publish_now(topic, message, retain, qos):
+            queue.dropped += 1
+
+    async def _sender_loop(self):
+        queue = self._publish_queue
+        while True:
+            topic, message, retain, qos = await queue.get()
+            if qos and self._client:
+                await self._client.wait_window()
+                utils.spawn(self._publish_async(queue, topic, message, retain, qos))
+            else:
+                await self._publish_async(queue, topic, message, retain, qos)
+            await utils.ayield(do_gc=False)
+
+    async def publish(self, topic, message, retain=False, qos=0, store=True):
+        if not self._can_publish():
+            if store and self._offline_store:
+                if isinstance(topic, PubTopic):
+                    topic = topic.name
+                return self._offline_store.append(topic, message, retain, qos)
+            return False
+        queue = self._publish_queue
+        if queue is None:
+            return await self._publish_now(topic, message, retain, qos)
+        if self._sender_task is None:
+            self._sender_task = asyncio.create_task(self._sender_loop())
+        return await queue.put((topic, message, retain, qos))
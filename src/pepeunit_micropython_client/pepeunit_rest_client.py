@@ -1,13 +1,79 @@
 import gc
+import os
 import ujson as json
+import uasyncio as asyncio
 import utils
 
-from .async_http import request
+from .async_http import request, stream, range_header, parse_content_range, InflateError
+from .json_stream import JsonArrayStream
+
+
+class PageIterator:
+    # Walks a limit/offset endpoint one item at a time. The next page is
+    # requested in the background while the current one is consumed, as
+    # long as mem_budget bytes of heap stay free.
+    def __init__(self, fetch, key, page_size=10, mem_budget=12000):
+        self.count = None
+        self._fetch = fetch
+        self._key = key
+        self._page_size = page_size
+        self._mem_budget = mem_budget
+        self._items = None
+        self._pos = 0
+        self._offset = 0
+        self._last = False
+        self._next = None
+
+    def __aiter__(self):
+        return self
+
+    async def _load(self):
+        if self._next is not None:
+            task = self._next
+            self._next = None
+            data = await task
+        else:
+            data = await self._fetch(self._page_size, self._offset)
+        self._items = data.get(self._key) or []
+        if 'count' in data:
+            self.count = data['count']
+        del data
+        self._pos = 0
+        self._offset += len(self._items)
+        self._last = len(self._items) < self._page_size or (self.count is not None and self._offset >= self.count)
+
+    def _prefetch(self):
+        if self._next is None and not self._last and utils.ensure_memory(self._mem_budget):
+            self._next = asyncio.create_task(self._fetch(self._page_size, self._offset))
+
+    async def __anext__(self):
+        if self._items is None or self._pos >= len(self._items):
+            if self._last:
+                raise StopAsyncIteration
+            self._items = None
+            gc.collect()
+            await self._load()
+            if not self._items:
+                raise StopAsyncIteration
+        item = self._items[self._pos]
+        self._items[self._pos] = None
+        self._pos += 1
+        self._prefetch()
+        return item
+
+    def close(self):
+        if self._next is not None:
+            self._next.cancel()
+            self._next = None
+        self._items = None
+        self._last = True
 
 
 class PepeunitRestClient:
-    def __init__(self, settings):
+    def __init__(self, settings, keep_alive=True, accept_gzip=False):
         self.settings = settings
+        self.keep_alive = keep_alive
+        self.accept_gzip = accept_gzip
 
     def _get_auth_headers(self, with_json=False):
         h = {'accept': 'application/json', 'x-auth-token': self.settings.PU_AUTH_TOKEN}
@@ -34,36 +100,212 @@ class PepeunitRestClient:
             msg += ": " + utils.to_str(body)
         raise OSError(msg)
 
-    async def _download_file(self, url, headers, file_path):
-        status, _, _ = await request(
-            "GET", url, headers=headers, save_to=file_path, bufsize=256, collect_headers=False,
+    @staticmethod
+    def _file_size(file_path):
+        try:
+            return os.stat(file_path)[6]
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _remove_quiet(file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _read_json(file_path):
+        try:
+            with open(file_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_json(file_path, data):
+        try:
+            with open(file_path, 'w') as f:
+                json.dump(data, f)
+        except OSError:
+            pass
+
+    async def _gzip_fallback(self, call):
+        if self.accept_gzip:
+            try:
+                return await call(True)
+            except InflateError:
+                # The server compresses with a window larger than GZIP_WBITS:
+                # stay uncompressed from now on.
+                self.accept_gzip = False
+        return await call(False)
+
+    async def _get_json_page(self, url, key, accept_gzip=False):
+        # List endpoints answer {"count": N, key: [...]}; items are decoded
+        # one by one while the body streams in instead of json.loads on the
+        # whole buffer.
+        items = []
+        parser = JsonArrayStream(key + '[*]', items.append)
+        resp = await stream(
+            "GET", url, headers=self._get_auth_headers(), bufsize=256, keep_alive=self.keep_alive,
+            accept_gzip=accept_gzip,
         )
-        self._raise_for_status(status)
+        try:
+            if resp.status >= 400:
+                self._raise_for_status(resp.status, bytes(await resp.readchunk(256)))
+            async for chunk in resp:
+                parser.feed(chunk)
+                await utils.ayield(do_gc=False)
+        finally:
+            resp.close()
+        if not parser.complete:
+            raise OSError("Truncated JSON response")
+        data = parser.fields
+        data[key] = items
+        gc.collect()
+        return data
+
+    async def _download_conditional(self, url, headers, file_path, accept_gzip=False):
+        # Sidecar validators: {"etag": ..., "last_modified": ...}. Only used
+        # while the file they describe is still on flash.
+        meta_path = file_path + '.etag'
+        meta = self._read_json(meta_path) if self._file_size(file_path) else {}
+        h = dict(headers)
+        if meta.get('etag'):
+            h['If-None-Match'] = meta['etag']
+        elif meta.get('last_modified'):
+            h['If-Modified-Since'] = meta['last_modified']
+
+        resp = await stream("GET", url, headers=h, bufsize=256, keep_alive=self.keep_alive, accept_gzip=accept_gzip)
+        tmp_path = file_path + '.tmp'
+        try:
+            if resp.status == 304:
+                return False
+            self._raise_for_status(resp.status)
+            try:
+                complete = await resp.save(tmp_path, bufsize=256)
+            except BaseException:
+                self._remove_quiet(tmp_path)
+                raise
+            etag = resp.headers.get(b'etag')
+            last_modified = resp.headers.get(b'last-modified')
+        finally:
+            resp.close()
+
+        if not complete:
+            self._remove_quiet(tmp_path)
+            raise OSError("Truncated download: {}".format(file_path))
+        # Validators go with the file they describe: drop the old ones before
+        # the swap, write the new ones only once the new file is in place.
+        self._remove_quiet(meta_path)
+        try:
+            os.rename(tmp_path, file_path)
+        except OSError:
+            self._remove_quiet(file_path)
+            os.rename(tmp_path, file_path)
+
+        if etag or last_modified:
+            self._write_json(meta_path, {
+                'etag': utils.to_str(etag) if etag else None,
+                'last_modified': utils.to_str(last_modified) if last_modified else None,
+            })
+        gc.collect()
+        return True
+
+    async def _download_resumable(self, url, headers, file_path, attempts=5):
+        # Sidecar checkpoint: {"offset": bytes on flash, "size": total, "etag": ...}.
+        ckpt_path = file_path + '.ckpt'
+        ckpt = self._read_json(ckpt_path)
+        offset = self._file_size(file_path) if ckpt else 0
+        complete = False
+
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep_ms(utils.backoff_interval_ms(attempt, 500, 8000))
+            h = dict(headers)
+            if offset:
+                h['Range'] = range_header(offset)
+                if ckpt.get('etag'):
+                    h['If-Range'] = ckpt['etag']
+            try:
+                resp = await stream("GET", url, headers=h, bufsize=256, keep_alive=self.keep_alive)
+            except OSError:
+                continue
+
+            try:
+                status = resp.status
+                if status == 416 and offset:
+                    complete = ckpt.get('size') == offset
+                    if complete:
+                        break
+                    offset, ckpt = 0, {}
+                    continue
+                self._raise_for_status(status)
+
+                if status == 206:
+                    start, total = parse_content_range(resp.headers.get(b'content-range', b''))
+                    size = ckpt.get('size', -1)
+                    if start != offset or (size >= 0 and total != size):
+                        offset, ckpt = 0, {}
+                        continue
+                else:
+                    offset = 0
+                    cl = resp.headers.get(b'content-length')
+                    total = int(cl) if cl else -1
+                etag = resp.headers.get(b'etag')
+                ckpt = {'offset': offset, 'size': total, 'etag': utils.to_str(etag) if etag else None}
+                self._write_json(ckpt_path, ckpt)
+
+                try:
+                    done = await resp.save(file_path, append=status == 206, bufsize=256)
+                except OSError:
+                    done = False
+            finally:
+                resp.close()
+
+            offset = self._file_size(file_path)
+            if done and (ckpt['size'] < 0 or offset == ckpt['size']):
+                complete = True
+                break
+            ckpt['offset'] = offset
+            self._write_json(ckpt_path, ckpt)
+
+        if not complete:
+            raise OSError("Download incomplete after {} attempts".format(attempts))
+        self._remove_quiet(ckpt_path)
+        gc.collect()
 
     async def download_update(self, file_path):
         url = self._build_url('/units/firmware/tgz/' + self.settings.unit_uuid + '?wbits=9&level=9')
-        await self._download_file(url, self._get_auth_headers(), file_path)
+        await self._download_resumable(url, self._get_auth_headers(), file_path)
 
     async def download_env(self, file_path):
         url = self._build_url('/units/env/' + self.settings.unit_uuid)
-        await self._download_file(url, self._get_auth_headers(), file_path)
+        return await self._gzip_fallback(
+            lambda gz: self._download_conditional(url, self._get_auth_headers(), file_path, gz)
+        )
 
     async def download_schema(self, file_path):
         url = self._build_url('/units/get_current_schema/' + self.settings.unit_uuid)
-        await self._download_file(url, self._get_auth_headers(), file_path)
+        return await self._gzip_fallback(
+            lambda gz: self._download_conditional(url, self._get_auth_headers(), file_path, gz)
+        )
 
     async def set_state_storage(self, state):
         url = self._build_url('/units/set_state_storage/' + self.settings.unit_uuid)
         payload = json.dumps({'state': state})
         status, _, _ = await request(
             "POST", url, headers=self._get_auth_headers(with_json=True), body=payload, collect_headers=False,
+            keep_alive=self.keep_alive,
         )
         self._raise_for_status(status)
         gc.collect()
 
     async def get_state_storage(self):
         url = self._build_url('/units/get_state_storage/' + self.settings.unit_uuid)
-        status, _, body = await request("GET", url, headers=self._get_auth_headers(), collect_headers=False)
+        status, _, body = await request(
+            "GET", url, headers=self._get_auth_headers(), collect_headers=False, keep_alive=self.keep_alive,
+        )
         self._raise_for_status(status, body)
         result = utils.to_str(body)
         del body
@@ -76,13 +318,7 @@ class PepeunitRestClient:
         url = self._build_url('/unit_nodes?' + query)
 
         gc.collect()
-        status, _, body = await request("GET", url, headers=self._get_auth_headers(), collect_headers=False)
-        self._raise_for_status(status, body)
-
-        data = json.loads(body)
-        del body
-        gc.collect()
-        return data
+        return await self._gzip_fallback(lambda gz: self._get_json_page(url, 'unit_nodes', gz))
 
     async def get_units_by_nodes(self, unit_node_uuids, limit=10, offset=0):
         if not unit_node_uuids:
@@ -102,10 +338,14 @@ class PepeunitRestClient:
         del parts
 
         gc.collect()
-        status, _, body = await request("GET", url, headers=self._get_auth_headers(), collect_headers=False)
-        self._raise_for_status(status, body)
+        return await self._gzip_fallback(lambda gz: self._get_json_page(url, 'units', gz))
 
-        data = json.loads(body)
-        del body
-        gc.collect()
-        return data
+    def iter_input_by_output(self, topic, page_size=10, mem_budget=12000):
+        async def fetch(limit, offset):
+            return await self.get_input_by_output(topic, limit, offset)
+        return PageIterator(fetch, 'unit_nodes', page_size, mem_budget)
+
+    def iter_units_by_nodes(self, unit_node_uuids, page_size=10, mem_budget=12000):
+        async def fetch(limit, offset):
+            return await self.get_units_by_nodes(unit_node_uuids, limit, offset)
+        return PageIterator(fetch, 'units', page_size, mem_budget)
@@ -0,0 +1,82 @@
+import uasyncio as asyncio
+
+from .enums import QueuePolicy
+
+
+class RingBuffer:
+    def __init__(self, capacity, policy=QueuePolicy.DROP_OLDEST, on_drop=None):
+        if capacity <= 0:
+            raise ValueError("RingBuffer capacity must be > 0")
+        self.capacity = capacity
+        self.policy = policy
+        self.dropped = 0
+        self.on_drop = on_drop
+        self._items = [None] * capacity
+        self._head = 0
+        self._count = 0
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def __len__(self):
+        return self._count
+
+    def _coalesce(self, item, key):
+        items = self._items
+        cap = self.capacity
+        for i in range(self._count):
+            idx = (self._head + i) % cap
+            if key(items[idx]) == key(item):
+                self._drop(items[idx])
+                items[idx] = item
+                return True
+        return False
+
+    def _drop(self, item):
+        self.dropped += 1
+        if self.on_drop:
+            self.on_drop(item)
+
+    def _pop_oldest(self):
+        item = self._items[self._head]
+        self._items[self._head] = None
+        self._head = (self._head + 1) % self.capacity
+        self._count -= 1
+        return item
+
+    def put_nowait(self, item, key=None):
+        if self._count >= self.capacity:
+            policy = self.policy
+            if policy == QueuePolicy.COALESCE_BY_TOPIC and key and self._coalesce(item, key):
+                return True
+            if policy == QueuePolicy.DROP_NEWEST or policy == QueuePolicy.BLOCK:
+                self._drop(item)
+                return False
+            self._drop(self._pop_oldest())
+
+        self._items[(self._head + self._count) % self.capacity] = item
+        self._count += 1
+        self._not_empty.set()
+        if self._count >= self.capacity:
+            self._not_full.clear()
+        return True
+
+    async def put(self, item, key=None):
+        if self.policy == QueuePolicy.BLOCK:
+            while self._count >= self.capacity:
+                await self._not_full.wait()
+        return self.put_nowait(item, key)
+
+    def get_nowait(self):
+        if not self._count:
+            return None
+        item = self._pop_oldest()
+        if not self._count:
+            self._not_empty.clear()
+        self._not_full.set()
+        return item
+
+    async def get(self):
+        while not self._count:
+            await self._not_empty.wait()
+        return self.get_nowait()
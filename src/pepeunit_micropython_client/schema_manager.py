@@ -3,24 +3,93 @@ from .enums import SearchTopicType, SearchScope, DestinationTopicType
 import utils
 import ujson as json
 
+from mqtt_as import PubTopic
+
 
 _SCOPE_SECTIONS_ALL = (DestinationTopicType.INPUT_TOPIC, DestinationTopicType.OUTPUT_TOPIC)
 _SCOPE_SECTIONS_INPUT = (DestinationTopicType.INPUT_TOPIC,)
 _SCOPE_SECTIONS_OUTPUT = (DestinationTopicType.OUTPUT_TOPIC,)
 _SCOPE_SECTIONS_EMPTY = ()
+_HASH_COLLISION = ('', None)
+# Input sections go last so they win if a topic is listed as both input and output.
+_INDEX_SECTIONS = (
+    DestinationTopicType.OUTPUT_BASE_TOPIC,
+    DestinationTopicType.OUTPUT_TOPIC,
+    DestinationTopicType.INPUT_BASE_TOPIC,
+    DestinationTopicType.INPUT_TOPIC,
+)
 
 
 class SchemaManager:
     def __init__(self, schema_file_path):
         self.schema_file_path = schema_file_path
+        self._output_handles = {}
+        self._topic_index = {}
+        self._hash_index = {}
+        self._uuid_index = {}
+        self._name_index = {}
         self._schema_data = self.update_from_file()
 
     def update_from_file(self):
         with open(self.schema_file_path, "r") as f:
             self._schema_data = json.load(f)
 
+        self._build_output_handles()
+        self._build_topic_index()
+        self._build_unit_node_indexes()
         return self._schema_data
 
+    def _build_output_handles(self):
+        self._output_handles = {}
+        for section in (self.output_base_topic, self.output_topic):
+            for topic_key, topic_list in section.items():
+                self._output_handles[topic_key] = tuple(PubTopic(topic) for topic in topic_list)
+
+    def get_output_handles(self, topic_key):
+        return self._output_handles.get(topic_key)
+
+    def _build_topic_index(self):
+        self._topic_index = {}
+        for section in _INDEX_SECTIONS:
+            for topic_key, topic_list in self._schema_data.get(section, {}).items():
+                entry = (section, topic_key)
+                for topic in topic_list:
+                    self._topic_index[topic] = entry
+        self._hash_index = {}
+        for topic, entry in self._topic_index.items():
+            if len(utils.to_bytes(topic)) != len(topic):
+                continue
+            h = utils.fnv1a(topic, len(topic))
+            self._hash_index[h] = _HASH_COLLISION if h in self._hash_index else (topic, entry)
+
+    def lookup_topic(self, topic):
+        return self._topic_index.get(topic)
+
+    def lookup_topic_view(self, topic):
+        # Allocation-free lookup for a bytes/memoryview topic; falls back to a
+        # decoded str on hash collisions or non-ASCII topics.
+        n = len(topic)
+        hit = self._hash_index.get(utils.fnv1a(topic, n))
+        if hit is not None and len(hit[0]) == n and utils.buf_eq(topic, hit[0], n):
+            return hit[1]
+        return self._topic_index.get(utils.to_str(topic))
+
+    def _build_unit_node_indexes(self):
+        self._uuid_index = {}
+        self._name_index = {}
+        for section in _SCOPE_SECTIONS_ALL:
+            uuids = {}
+            names = {}
+            for topic_key, topic_list in self._schema_data.get(section, {}).items():
+                for topic_url in topic_list:
+                    uuid = utils.extract_uuid_from_topic(topic_url)
+                    if uuid not in uuids:
+                        uuids[uuid] = topic_key
+                    if topic_url not in names:
+                        names[topic_url] = topic_key
+            self._uuid_index[section] = uuids
+            self._name_index[section] = names
+
     @property
     def input_base_topic(self):
         return self._schema_data.get(DestinationTopicType.INPUT_BASE_TOPIC, {})
@@ -37,23 +106,22 @@ class SchemaManager:
     def output_topic(self):
         return self._schema_data.get(DestinationTopicType.OUTPUT_TOPIC, {})
 
-    async def find_topic_by_unit_node(self, search_value, search_type, search_scope=SearchScope.ALL):
-        sections = self._get_sections_by_scope(search_scope)
+    def lookup_topic_by_unit_node(self, search_value, search_type, search_scope=SearchScope.ALL):
         if search_type == SearchTopicType.UNIT_NODE_UUID:
-            search_fn = self._search_uuid_in_topic_section
+            index = self._uuid_index
         elif search_type == SearchTopicType.FULL_NAME:
-            search_fn = self._search_topic_name_in_section
+            index = self._name_index
         else:
-            search_fn = None
-        for section in sections:
-            if search_fn is None:
-                result = None
-            else:
-                result = await search_fn(section, search_value)
+            return None
+        for section in self._get_sections_by_scope(search_scope):
+            result = index[section].get(search_value)
             if result:
                 return result
         return None
 
+    async def find_topic_by_unit_node(self, search_value, search_type, search_scope=SearchScope.ALL):
+        return self.lookup_topic_by_unit_node(search_value, search_type, search_scope)
+
     def _get_sections_by_scope(self, search_scope):
         if search_scope == SearchScope.ALL:
             return _SCOPE_SECTIONS_ALL
@@ -63,40 +131,3 @@ class SchemaManager:
             return _SCOPE_SECTIONS_OUTPUT
         else:
             return _SCOPE_SECTIONS_EMPTY
-
-    async def _search_uuid_in_topic_section(self, section, uuid):
-        topic_section = self._schema_data.get(section, {})
-        idx = 0
-        for topic_name, topic_list in topic_section.items():
-            for topic_url in topic_list:
-                if self._topic_url_matches_uuid(topic_url, uuid):
-                    return topic_name
-                idx += 1
-                await utils.ayield(idx, every=32)
-        return None
-
-    def _topic_url_matches_uuid(self, topic_url, uuid):
-        if uuid is None:
-            return utils.extract_uuid_from_topic(topic_url) is None
-
-        first = topic_url.find('/')
-        if first < 0:
-            return False
-
-        start = first + 1
-        if not topic_url.startswith(uuid, start):
-            return False
-
-        end = start + len(uuid)
-        return (end == len(topic_url)) or (topic_url[end] == '/')
-
-    async def _search_topic_name_in_section(self, section, topic_name):
-        topic_section = self._schema_data.get(section, {})
-        idx = 0
-        for topic_key, topic_list in topic_section.items():
-            for topic_url in topic_list:
-                if topic_url == topic_name:
-                    return topic_key
-                idx += 1
-                await utils.ayield(idx, every=32)
-        return None
@@ -22,6 +22,10 @@ class Settings:
     PUC_WIFI_SSID = ''
     PUC_WIFI_PASS = ''
     PUC_MAX_RECONNECTION_INTERVAL = 60000
+    PUC_MQTT_SUB_PACKET_SIZE = 256
+    PUC_MQTT_MAX_INFLIGHT = 4
+    PUC_MQTT_MAX_PAYLOAD = 0
+    PUC_MQTT_SPOOL_PATH = '/mqtt_spool'
 
     def __init__(self, env_file_path=None, **kwargs):
         self.env_file_path = env_file_path
@@ -1,8 +1,18 @@
 import gc
+import micropython
+import socket
+import time
 import ubinascii as binascii
 import uasyncio as asyncio
 
 
+DNS_TTL_MS = 300000
+DNS_NEGATIVE_TTL_MS = 10000
+
+# (host, port) -> (addr or None, created_ms, ttl_ms); None marks a failed lookup.
+_dns_cache = {}
+
+
 def to_bytes(value):
     if value is None:
         return b""
@@ -23,6 +33,25 @@ def to_str(value):
     return str(value)
 
 
+@micropython.viper
+def fnv1a(buf, n: int) -> int:
+    p = ptr8(buf)
+    h = 0x1C9DC5
+    for i in range(n):
+        h = ((h ^ p[i]) * 0x1000193) & 0x3FFFFFFF
+    return h
+
+
+@micropython.viper
+def buf_eq(a, b, n: int) -> bool:
+    pa = ptr8(a)
+    pb = ptr8(b)
+    for i in range(n):
+        if pa[i] != pb[i]:
+            return False
+    return True
+
+
 def backoff_interval_ms(attempt, base_ms, max_ms):
     if attempt <= 0:
         return 0
@@ -98,3 +127,38 @@ async def ayield(counter=None, every=32, mem_free_threshold=8000, do_gc=True):
     if do_gc and gc.mem_free() < mem_free_threshold:
         gc.collect()
     await asyncio.sleep_ms(0)
+
+
+def _dns_entry_fresh(entry, now):
+    age = time.ticks_diff(now, entry[1])
+    return 0 <= age < entry[2]
+
+
+def forget_address(host, port=None):
+    for key in [k for k in _dns_cache if k[0] == host and (port is None or k[1] == port)]:
+        del _dns_cache[key]
+
+
+async def resolve(host, port, refresh=False, retries=4):
+    key = (host, port)
+    entry = _dns_cache.get(key)
+    if entry and not refresh and _dns_entry_fresh(entry, time.ticks_ms()):
+        if entry[0] is None:
+            raise OSError(-2, "DNS lookup failed recently for " + host)
+        return entry[0]
+
+    for attempt in range(retries):
+        try:
+            await asyncio.sleep_ms(0)
+            addr = socket.getaddrinfo(host, port)[0][-1]
+            break
+        except OSError as e:
+            if e.args and e.args[0] == -2 and attempt < retries - 1:
+                gc.collect()
+                await asyncio.sleep_ms(200 * (attempt + 1))
+                continue
+            _dns_cache[key] = (None, time.ticks_ms(), DNS_NEGATIVE_TTL_MS)
+            raise
+
+    _dns_cache[key] = (addr, time.ticks_ms(), DNS_TTL_MS)
+    return addr